@@ -0,0 +1,906 @@
+"""Offline benchmark of mirroring Instagram posts and stories to VK.
+
+Instagram is replaced by fake instaloader session serving synthetic profiles from local
+directory and VK by local HTTP server emulating VK API and upload servers. Both fakes have
+configurable latency, error rates and throttling, so results of different commits run with
+the same arguments can be compared. Every run starts in empty working directory.
+
+Example:
+    python benchmark.py --profiles 10 --posts 20 --modes batch pipeline zero_disk --output before.json
+    python benchmark.py --profiles 10 --posts 20 --modes batch pipeline zero_disk --compare before.json
+    python benchmark.py --posts 0 --stories 3 --modes batch --scaling 10 40 80
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlparse
+
+import instaloader
+import vk_api
+
+import instagram_to_vk as mirror
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MODES = ('batch', 'pipeline', 'zero_disk')
+# Instagram returns posts of profile by pages of 12
+INST_PAGE_SIZE = 12
+CDN_CHUNK_SIZE = 64*1024
+# Completion latency percentiles stored in results
+PERCENTILES = (50, 90, 99)
+
+
+class Workload(NamedTuple):
+    """Synthetic Instagram profiles to be mirrored."""
+    profiles: int
+    posts: int
+    stories: int
+    media_per_post: int
+    video_share: float
+    image_side: int
+    video_size: int
+    seed: int
+
+
+class FakeMedia(NamedTuple):
+    """Image or video of fake post or story item."""
+    is_video: bool
+    url: str
+
+    @property
+    def display_url(self) -> str:
+        return self.url
+
+    @property
+    def video_url(self) -> str:
+        return self.url
+
+
+class FakePost(NamedTuple):
+    """Post with the attributes of instaloader.Post used by mirror."""
+    shortcode: str
+    date: datetime
+    caption: str
+    media: list
+
+    @property
+    def typename(self) -> str:
+        return 'GraphSidecar' if len(self.media) > 1 else 'GraphImage'
+
+    @property
+    def is_video(self) -> bool:
+        return self.media[0].is_video
+
+    @property
+    def url(self) -> str:
+        return self.media[0].url
+
+    @property
+    def video_url(self) -> str:
+        return self.media[0].url
+
+    def get_sidecar_nodes(self) -> list:
+        return self.media
+
+
+class FakeStoryItem(NamedTuple):
+    """Story item with the attributes of instaloader.StoryItem used by mirror."""
+    mediaid: int
+    date: datetime
+    media: FakeMedia
+
+    @property
+    def is_video(self) -> bool:
+        return self.media.is_video
+
+    @property
+    def url(self) -> str:
+        return self.media.url
+
+    @property
+    def video_url(self) -> str:
+        return self.media.url
+
+
+class FakeProfile():
+    def __init__(self, context: 'FakeInstagramContext', username: str, userid: int, posts: list, stories: list) -> None:
+        """Profile with the attributes of instaloader.Profile used by mirror.
+
+        Args:
+            context (FakeInstagramContext): Context to make requests with.
+            username (str): Instagram username.
+            userid (int): Instagram userid.
+            posts (list): List of FakePost, newest first.
+            stories (list): List of FakeStoryItem, newest first.
+        """
+        self.context = context
+        self.username = username
+        self.userid = userid
+        self.full_name = username.title()
+        self.posts = posts
+        self.stories = stories
+
+    def get_posts(self):
+        """Yielding posts newest first, every page of posts costs one request like in Instagram."""
+        for number, post in enumerate(self.posts):
+            if number % INST_PAGE_SIZE == 0:
+                self.context.get_json(f'posts/{self.username}', {'after': number})
+            yield post
+
+
+class FakeStory():
+    def __init__(self, profile: FakeProfile) -> None:
+        """Story with the attributes of instaloader.Story used by mirror.
+
+        Args:
+            profile (FakeProfile): Owner of story.
+        """
+        self.owner_profile = profile
+        self.owner_id = profile.userid
+
+    def get_items(self):
+        yield from self.owner_profile.stories
+
+
+class FakeResponse():
+    def __init__(self, path: str) -> None:
+        """Response of Instagram CDN reading media from local file.
+
+        Args:
+            path (str): Path to media file.
+        """
+        self.path = path
+
+    def iter_content(self, chunk_size: int = CDN_CHUNK_SIZE):
+        with open(self.path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                yield chunk
+
+
+class FakeInstagramContext():
+    def __init__(self,
+                 cdn_dir: str,
+                 latency: float,
+                 error_rate: float,
+                 throttle_rate: float,
+                 throttle_penalty: float,
+                 seed: int) -> None:
+        """Instagram context serving profiles and media of workload with latency, errors and throttling.
+        Throttled request waits for throttle_penalty like instaloader does after 429 response,
+        failed request raises instaloader.exceptions.ConnectionException.
+
+        Args:
+            cdn_dir (str): Directory with generated media files.
+            latency (float): Mean latency of request in seconds.
+            error_rate (float): Share of failed requests.
+            throttle_rate (float): Share of requests answered with 429.
+            throttle_penalty (float): Seconds waited after 429.
+            seed (int): Seed of random generator.
+        """
+        self.cdn_dir = cdn_dir
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.throttle_penalty = throttle_penalty
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.profiles = dict()
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def request(self, name: str) -> None:
+        """Emulating single request to Instagram.
+
+        Args:
+            name (str): Requested resource, used in error message.
+
+        Raises:
+            instaloader.exceptions.ConnectionException: If request failed.
+        """
+        with self.lock:
+            self.requests += 1
+            latency = self.random.uniform(0.5, 1.5)*self.latency
+            throttled = self.random.random() < self.throttle_rate
+            failed = self.random.random() < self.error_rate
+            self.throttled += throttled
+            self.errors += failed
+        time.sleep(latency + throttled*self.throttle_penalty)
+        if failed:
+            raise instaloader.exceptions.ConnectionException(f'{name}: fake connection error')
+
+    def get_json(self, path: str, params: dict = None) -> dict:
+        self.request(path)
+        return dict()
+
+    def get_raw(self, url: str) -> FakeResponse:
+        self.request(url)
+        return FakeResponse(os.path.join(self.cdn_dir, urlparse(url).path.lstrip('/')))
+
+    def profile(self, username: str) -> FakeProfile:
+        """Loading profile like instaloader.Profile.from_username.
+
+        Args:
+            username (str): Instagram username.
+
+        Raises:
+            instaloader.exceptions.ProfileNotExistsException: If there is no such profile.
+
+        Returns:
+            FakeProfile: Loaded profile.
+        """
+        self.get_json(f'profile/{username}')
+        if username not in self.profiles:
+            raise instaloader.exceptions.ProfileNotExistsException(username)
+        return self.profiles[username]
+
+
+class FakeInstaloader():
+    def __init__(self, context: FakeInstagramContext) -> None:
+        """Instagram session with the methods of instaloader.Instaloader used by mirror,
+        downloading media into spool directory in the same layout as instaloader.
+
+        Args:
+            context (FakeInstagramContext): Context to make requests with.
+        """
+        self.context = context
+
+    def download_post(self, post: FakePost, target: str) -> bool:
+        for number, media in enumerate(post.media, start=1):
+            suffix = f'_{number}' if len(post.media) > 1 else ''
+            self.download_media(media, target, f'{post.date:%Y-%m-%d_%H-%M-%S}_UTC{suffix}')
+        with open(os.path.join(mirror.SPOOL_DIR, target, f'{post.date:%Y-%m-%d_%H-%M-%S}_UTC.txt'),
+                  'w', encoding='UTF-8') as file:
+            file.write(post.caption)
+        return True
+
+    def download_storyitem(self, item: FakeStoryItem, target: str) -> bool:
+        self.download_media(item.media, target, f'{item.date:%Y-%m-%d_%H-%M-%S}_UTC')
+        return True
+
+    def download_media(self, media: FakeMedia, target: str, name: str) -> None:
+        folder = os.path.join(mirror.SPOOL_DIR, target)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name + ('.mp4' if media.is_video else '.jpg'))
+        with open(path, 'wb') as file:
+            for chunk in self.context.get_raw(media.url).iter_content():
+                file.write(chunk)
+
+    def get_stories(self, userids: list):
+        self.context.get_json('stories', {'reel_ids': userids})
+        by_userid = {profile.userid: profile for profile in self.context.profiles.values()}
+        for userid in userids:
+            profile = by_userid.get(userid)
+            if profile is not None and profile.stories:
+                yield FakeStory(profile)
+
+
+class FakeVkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self,
+                 latency: float,
+                 error_rate: float,
+                 flood_rate: float,
+                 api_rps: float,
+                 upload_rps: float,
+                 seed: int) -> None:
+        """Local HTTP server emulating VK API and upload servers. API requests above api_rps are answered
+        with error 6, random share of them with flood control error 9 and failed ones with error 10.
+        Upload requests above upload_rps are answered with 429 and failed ones with 500.
+
+        Args:
+            latency (float): Mean latency of request in seconds.
+            error_rate (float): Share of failed requests.
+            flood_rate (float): Share of API requests answered with flood control error.
+            api_rps (float): API requests per second allowed.
+            upload_rps (float): Upload requests per second allowed.
+            seed (int): Seed of random generator.
+        """
+        super().__init__(('127.0.0.1', 0), FakeVkHandler)
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.limits = {'api': (api_rps, deque()), 'upload': (upload_rps, deque())}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.stats = {'api_calls': 0, 'upload_requests': 0, 'throttled': 0, 'errors': 0,
+                      'photos': 0, 'videos': 0, 'bytes': 0}
+        # Times when photos and videos were saved in VK
+        self.completions = list()
+
+    def __enter__(self) -> 'FakeVkServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def admit(self, kind: str) -> str:
+        """Waiting latency of request and deciding its outcome.
+
+        Args:
+            kind (str): api or upload.
+
+        Returns:
+            str: None if request succeeds, 'throttled', 'flood' or 'error' otherwise.
+        """
+        with self.lock:
+            latency = self.random.uniform(0.5, 1.5)*self.latency
+            rate, calls = self.limits[kind]
+            now = time.monotonic()
+            while calls and calls[0] <= now - 1.0:
+                calls.popleft()
+            outcome = None
+            if len(calls) >= rate:
+                outcome = 'throttled'
+            elif kind == 'api' and self.random.random() < self.flood_rate:
+                outcome = 'flood'
+            elif self.random.random() < self.error_rate:
+                outcome = 'error'
+            else:
+                calls.append(now)
+            self.stats['api_calls' if kind == 'api' else 'upload_requests'] += 1
+            self.stats['throttled'] += outcome in ('throttled', 'flood')
+            self.stats['errors'] += outcome == 'error'
+        time.sleep(latency)
+        return outcome
+
+    def new_ids(self, count: int, kind: str) -> list:
+        """Get ids of new photos or videos and store time of their saving.
+
+        Args:
+            count (int): Number of ids.
+            kind (str): photos or videos.
+
+        Returns:
+            list: New ids.
+        """
+        with self.lock:
+            ids = list(range(self.next_id, self.next_id + count))
+            self.next_id += count
+            self.stats[kind] += count
+            self.completions.extend([time.perf_counter()]*count)
+        return ids
+
+    def call(self, method: str, values: dict):
+        """Get response of VK API method.
+
+        Args:
+            method (str): Method name.
+            values (dict): Parameters of method.
+
+        Returns:
+            Response of method.
+        """
+        if method == 'execute':
+            return [self.call(name, call_values) for name, call_values in self.parse_execute(values['code'])]
+        owner_id = -int(values.get('group_id', 1))
+        if method == 'photos.getUploadServer':
+            return {'upload_url': f'{self.url}/upload/photo?aid={values.get("album_id")}',
+                    'album_id': values.get('album_id'), 'user_id': 1}
+        if method == 'photos.save':
+            photos = json.loads(values['photos_list'])
+            return [{'owner_id': owner_id, 'id': photo_id, 'album_id': values.get('album_id')}
+                    for photo_id in self.new_ids(len(photos), 'photos')]
+        if method == 'video.save':
+            with self.lock:
+                video_id = self.next_id
+                self.next_id += 1
+            return {'upload_url': f'{self.url}/upload/video?vid={video_id}',
+                    'owner_id': owner_id, 'video_id': video_id}
+        return 1
+
+
+    @staticmethod
+    def parse_execute(code: str) -> list:
+        """Get calls of execute code in form return [API.method({...}),API.method({...})];
+
+        Args:
+            code (str): Code of execute request.
+
+        Returns:
+            list: Tuples (method, values).
+        """
+        decoder = json.JSONDecoder()
+        calls = list()
+        position = code.index('[') + 1
+        while code.startswith('API.', position):
+            start = code.index('(', position)
+            values, end = decoder.raw_decode(code, start + 1)
+            calls.append((code[position + len('API.'):start], values))
+            position = end + len('),') if code.startswith('),', end) else end + len(')')
+        return calls
+
+
+class FakeVkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlparse(self.path)
+        if url.path.startswith('/method/'):
+            self.api(url.path[len('/method/'):], body)
+        else:
+            self.upload(url.path, body)
+
+    def api(self, method: str, body: bytes) -> None:
+        outcome = self.server.admit('api')
+        if outcome is None:
+            values = {key: value[-1] for key, value in parse_qs(body.decode()).items()}
+            self.reply(200, {'response': self.server.call(method, values)})
+            return
+        codes = {'throttled': (6, 'Too many requests per second'),
+                 'flood': (9, 'Flood control'),
+                 'error': (10, 'Internal server error')}
+        code, message = codes[outcome]
+        self.reply(200, {'error': {'error_code': code, 'error_msg': message, 'request_params': []}})
+
+    def upload(self, path: str, body: bytes) -> None:
+        outcome = self.server.admit('upload')
+        if outcome is not None:
+            # Upload servers answer errors with HTML page of proxy
+            self.reply(429 if outcome == 'throttled' else 500, f'<html>{outcome}</html>')
+            return
+        with self.server.lock:
+            self.server.stats['bytes'] += len(body)
+        if path == '/upload/photo':
+            photos = [{'photo': number} for number in range(body.count(b'filename="'))]
+            self.reply(200, {'server': 1, 'photos_list': json.dumps(photos), 'aid': 1, 'hash': 'fake'})
+            return
+        # Content-Range: bytes start-end/size
+        end, size = self.headers['Content-Range'].split('-')[1].split('/')
+        if int(end) + 1 == int(size):
+            self.server.new_ids(1, 'videos')
+            self.reply(200, {'result': 'ok'})
+        else:
+            self.reply(201, {'result': 'partial'})
+
+    def reply(self, status: int, response) -> None:
+        if isinstance(response, str):
+            data, content_type = response.encode(), 'text/html'
+        else:
+            data, content_type = json.dumps(response).encode(), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class FakeVkApi(vk_api.VkApi):
+    def __init__(self, url: str) -> None:
+        """VK session sending API calls to fake VK server. VkUpload and mirror use it as usual VK session.
+
+        Args:
+            url (str): Url of fake VK server.
+        """
+        super().__init__(token='benchmark', config_filename='vk_config.benchmark.json')
+        self.url = url
+
+    def method(self, method: str, values: dict = None, captcha_sid=None, captcha_key=None, raw: bool = False):
+        response = self.http.post(f'{self.url}/method/{method}', values or dict()).json()
+        if 'error' in response:
+            raise vk_api.exceptions.ApiError(self, method, values, response, response['error'])
+        return response if raw else response['response']
+
+
+class SpoolSampler():
+    def __init__(self, path: str, interval: float = 0.05) -> None:
+        """Sampling size of spool directory in background while used as context manager.
+
+        Args:
+            path (str): Spool directory.
+            interval (float, optional): Seconds between samples. Defaults to 0.05.
+        """
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def __enter__(self) -> 'SpoolSampler':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stopping.set()
+        self.thread.join()
+
+    def sample(self) -> None:
+        while True:
+            size = 0
+            for directory, _, files in os.walk(self.path):
+                for file in files:
+                    with contextlib.suppress(OSError):
+                        size += os.path.getsize(os.path.join(directory, file))
+            self.peak = max(self.peak, size)
+            if self.stopping.wait(self.interval):
+                return
+
+
+class Benchmark():
+    def __init__(self, workload: Workload, args: argparse.Namespace, root: str) -> None:
+        """Generating media of workload once, it is shared by all runs.
+
+        Args:
+            workload (Workload): Synthetic profiles to be mirrored.
+            args (argparse.Namespace): Parsed arguments with settings of fakes.
+            root (str): Directory for generated media and working directories of runs.
+        """
+        self.workload = workload
+        self.args = args
+        self.root = root
+        self.cdn_dir = os.path.join(root, 'cdn')
+        self.date_now = datetime.utcnow()
+        self.generate_media()
+
+    def generate_media(self) -> None:
+        """Writing distinct image and video of every media of workload to CDN directory.
+        Images are real JPEG noise if Pillow is installed, so perceptual hashes differ.
+        """
+        os.makedirs(self.cdn_dir, exist_ok=True)
+        rng = random.Random(self.workload.seed)
+        self.media = dict()
+        for profile in range(self.workload.profiles):
+            count = (self.workload.posts*self.workload.media_per_post + self.workload.stories)
+            for number in range(count):
+                is_video = rng.random() < self.workload.video_share
+                name = f'{profile}_{number}.{"mp4" if is_video else "jpg"}'
+                path = os.path.join(self.cdn_dir, name)
+                if is_video:
+                    data = rng.randbytes(self.workload.video_size)
+                elif Image is not None:
+                    side = self.workload.image_side
+                    image = Image.frombytes('L', (side, side), rng.randbytes(side*side))
+                    buffer = io.BytesIO()
+                    image.save(buffer, 'JPEG', quality=90)
+                    data = buffer.getvalue()
+                else:
+                    data = rng.randbytes(self.workload.image_side**2//4)
+                with open(path, 'wb') as file:
+                    file.write(data)
+                self.media[(profile, number)] = FakeMedia(is_video, f'https://cdn.fake/{name}')
+
+    def profiles(self, context: FakeInstagramContext) -> None:
+        """Adding profiles of workload to fake context.
+
+        Args:
+            context (FakeInstagramContext): Context of fake Instagram session.
+        """
+        for profile in range(self.workload.profiles):
+            posts = list()
+            for number in range(self.workload.posts):
+                first = number*self.workload.media_per_post
+                posts.append(FakePost(
+                    f'p{profile}x{number}', self.date_now - timedelta(minutes=number + 1),
+                    f'Post {number} of @user{profile}',
+                    [self.media[(profile, first + item)] for item in range(self.workload.media_per_post)]))
+            first = self.workload.posts*self.workload.media_per_post
+            stories = [FakeStoryItem(profile*100000 + number, self.date_now - timedelta(minutes=number + 1),
+                                     self.media[(profile, first + number)])
+                       for number in range(self.workload.stories)]
+            username = f'user{profile}'
+            context.profiles[username] = FakeProfile(
+                context, username, 1000 + profile, posts, stories)
+
+    def links(self) -> list:
+        """Get links file with own VK albums for every profile.
+
+        Returns:
+            list: Rows of links file as dicts by column name.
+        """
+        rows = list()
+        for profile in range(self.workload.profiles):
+            group = 100 + profile
+            rows.append({
+                'Instagram Link': f'https://www.instagram.com/user{profile}/',
+                'VK album link post photo': f'https://vk.com/album-{group}_1',
+                'VK album link post video': f'https://vk.com/videos-{group}?section=album_2',
+                'VK album link stories photo': f'https://vk.com/album-{group}_3',
+                'VK album link stories video': f'https://vk.com/videos-{group}?section=album_4',
+            })
+        return rows
+
+    def run(self, mode: str, repeat: int) -> dict:
+        """Mirroring whole workload once in empty working directory.
+
+        Args:
+            mode (str): batch, pipeline or zero_disk.
+            repeat (int): Number of run, used in name of working directory.
+
+        Returns:
+            dict: Results of run.
+        """
+        workdir = os.path.join(self.root, f'{mode}_{repeat}')
+        os.makedirs(workdir)
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            return self.measure(mode)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def measure(self, mode: str) -> dict:
+        """Running single sync cycle against fresh fakes and measuring it.
+
+        Args:
+            mode (str): batch, pipeline or zero_disk.
+
+        Returns:
+            dict: Results of run.
+        """
+        args = self.args
+        context = FakeInstagramContext(self.cdn_dir, args.inst_latency, args.inst_error_rate,
+                                       args.inst_throttle_rate, args.inst_throttle_penalty, self.workload.seed)
+        self.profiles(context)
+        with FakeVkServer(args.vk_latency, args.vk_error_rate, args.vk_flood_rate,
+                          args.vk_api_rps, args.vk_upload_rps, self.workload.seed) as server:
+            vk_session = FakeVkApi(server.url)
+            mirror.AdaptiveRateLimiter(args.vk_rate).install(vk_session)
+            if not args.no_execute_batching:
+                mirror.ExecuteBatcher().install(vk_session)
+            data = SimpleNamespace(
+                inst_session=FakeInstaloader(context),
+                vk_session=vk_session,
+                routes=mirror.LinkIndex(self.links()),
+                date_now=self.date_now,
+                cursors=mirror.ProfileCursors(self.date_now - timedelta(days=1), self.date_now),
+                ledger=mirror.MirrorLedger(),
+                profiles=mirror.ProfileCache(context, loader=context.profile),
+                budget=mirror.RequestBudget(hourly_budget=args.inst_budget),
+            )
+            mirror.INST_REQUESTS_PER_SECOND = args.inst_rate
+            mirror.METRICS.reset()
+
+            output = sys.stdout if args.verbose else io.StringIO()
+            spool = SpoolSampler(mirror.SPOOL_DIR)
+            tracemalloc.start()
+            start = time.perf_counter()
+            error = None
+            with spool, contextlib.redirect_stdout(output):
+                try:
+                    mirror.run_cycle(data, pipeline=mode == 'pipeline', zero_disk=mode == 'zero_disk',
+                                     optimize_images=args.optimize_images)
+                except Exception as e:
+                    # Failed cycle is recorded with what it managed to upload instead of stopping benchmark
+                    error = repr(e)
+            wall_time = time.perf_counter() - start
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            data.ledger.connection.close()
+
+            metrics = None
+            if error is None:
+                with open(mirror.METRICS_PATH) as file:
+                    metrics = json.loads(file.readlines()[-1])
+            completions = sorted(completion - start for completion in server.completions)
+            stats = dict(server.stats)
+
+        uploaded = stats['photos'] + stats['videos']
+        return {
+            'mode': mode,
+            'error': error,
+            'wall_seconds': wall_time,
+            'media_uploaded': uploaded,
+            'media_expected': len(self.media),
+            'media_per_second': uploaded/wall_time,
+            'megabytes_per_second': stats['bytes']/wall_time/1024/1024,
+            'completion_seconds': {f'p{percentile}': self.percentile(completions, percentile)
+                                   for percentile in PERCENTILES},
+            'peak_memory_bytes': peak_memory,
+            'peak_spool_bytes': spool.peak,
+            'instagram': {'requests': context.requests, 'errors': context.errors,
+                          'throttled': context.throttled},
+            'vk': stats,
+            'metrics': metrics,
+        }
+
+    @staticmethod
+    def percentile(values: list, percentile: int) -> float:
+        """Get percentile of sorted values by nearest rank.
+
+        Args:
+            values (list): Sorted values.
+            percentile (int): Percentile from 0 to 100.
+
+        Returns:
+            float: Value of percentile, None if there are no values.
+        """
+        if not values:
+            return None
+        return values[min(len(values) - 1, max(0, round(percentile/100*len(values)) - 1))]
+
+
+def git_revision() -> dict:
+    """Get commit of working tree, so results of different commits can be told apart.
+
+    Returns:
+        dict: Commit hash and True if tree has uncommitted changes.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': dirty}
+
+
+def run_workload(workload: Workload, args: argparse.Namespace) -> list:
+    """Running every mode of arguments on workload in temporary directory.
+
+    Args:
+        workload (Workload): Synthetic profiles to be mirrored.
+        args (argparse.Namespace): Parsed arguments.
+
+    Returns:
+        list: Results of runs.
+    """
+    with tempfile.TemporaryDirectory(prefix='instagram_to_vk_benchmark_') as root:
+        benchmark = Benchmark(workload, args, root)
+        return [benchmark.run(mode, repeat)
+                for repeat in range(args.repeat) for mode in args.modes]
+
+
+def summarize(runs: list) -> dict:
+    """Get medians of repeated runs of every mode.
+
+    Args:
+        runs (list): Results of runs.
+
+    Returns:
+        dict: Medians of wall time, throughput, completion latency and peak memory by mode.
+    """
+    summary = dict()
+    for mode in dict.fromkeys(run['mode'] for run in runs):
+        mode_runs = [run for run in runs if run['mode'] == mode]
+        summary[mode] = {
+            'wall_seconds': statistics.median(run['wall_seconds'] for run in mode_runs),
+            'media_per_second': statistics.median(run['media_per_second'] for run in mode_runs),
+            'completion_p90_seconds': statistics.median(
+                run['completion_seconds']['p90'] or 0.0 for run in mode_runs),
+            'peak_memory_bytes': statistics.median(run['peak_memory_bytes'] for run in mode_runs),
+            'peak_spool_bytes': statistics.median(run['peak_spool_bytes'] for run in mode_runs),
+            'media_uploaded': min(run['media_uploaded'] for run in mode_runs),
+            'failed_runs': sum(run['error'] is not None for run in mode_runs),
+        }
+    return summary
+
+
+def report(summary: dict, baseline: dict = None) -> None:
+    """Printing summary of modes, with change against baseline summary if provided.
+
+    Args:
+        summary (dict): Summary of current runs.
+        baseline (dict, optional): Summary of stored runs. Defaults to None.
+    """
+    for mode, result in summary.items():
+        print(f'{mode}: {result["wall_seconds"]:.2f}s, {result["media_per_second"]:.1f} media/s, '
+              f'p90 completion {result["completion_p90_seconds"]:.2f}s, '
+              f'peak memory {result["peak_memory_bytes"]/1024/1024:.1f} MiB, '
+              f'{result["media_uploaded"]} media uploaded')
+        if result.get('failed_runs'):
+            print(f'  failed runs: {result["failed_runs"]}, their errors are stored in results')
+        if baseline is not None and mode in baseline:
+            changes = ', '.join(
+                f'{key} {result[key]/baseline[mode][key] - 1:+.1%}'
+                for key in ('wall_seconds', 'media_per_second', 'peak_memory_bytes') if baseline[mode][key])
+            print(f'  against baseline: {changes}')
+
+
+def report_scaling(scaling: dict) -> None:
+    """Printing peak memory, peak spool size and wall time of every mode by number of profiles.
+    Bounded handling means peaks stay nearly the same while number of profiles grows.
+
+    Args:
+        scaling (dict): Summaries by number of profiles.
+    """
+    counts = sorted(scaling)
+    for mode in scaling[counts[0]]:
+        peaks = [scaling[count][mode]['peak_memory_bytes'] for count in counts]
+        points = ', '.join(f'{count} profiles {peak/1024/1024:.1f} MiB, '
+                           f'spool {scaling[count][mode]["peak_spool_bytes"]/1024/1024:.1f} MiB '
+                           f'in {scaling[count][mode]["wall_seconds"]:.2f}s'
+                           for count, peak in zip(counts, peaks))
+        print(f'{mode} scaling: {points}; peak memory grew x{peaks[-1]/peaks[0]:.2f} '
+              f'for x{counts[-1]/counts[0]:.1f} profiles')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark mirroring synthetic Instagram profiles to fake VK server.')
+    parser.add_argument('--profiles', type=int, default=8, help='number of Instagram profiles')
+    parser.add_argument('--posts', type=int, default=10, help='new posts of every profile')
+    parser.add_argument('--stories', type=int, default=2, help='new story items of every profile')
+    parser.add_argument('--media-per-post', type=int, default=2, help='images and videos in every post')
+    parser.add_argument('--video-share', type=float, default=0.1, help='share of media which are videos')
+    parser.add_argument('--image-side', type=int, default=512, help='side of generated images in pixels')
+    parser.add_argument('--video-size', type=int, default=2*1024*1024, help='size of generated videos in bytes')
+    parser.add_argument('--seed', type=int, default=1, help='seed of workload and fakes')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help='modes to be run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of every mode')
+    parser.add_argument('--optimize-images', action='store_true', help='optimize images before uploading')
+    parser.add_argument('--inst-latency', type=float, default=0.02, help='mean Instagram latency in seconds')
+    parser.add_argument('--inst-error-rate', type=float, default=0.0, help='share of failed Instagram requests')
+    parser.add_argument('--inst-throttle-rate', type=float, default=0.0,
+                        help='share of Instagram requests answered with 429')
+    parser.add_argument('--inst-throttle-penalty', type=float, default=1.0, help='seconds waited after 429')
+    parser.add_argument('--inst-rate', type=float, default=50.0, help='Instagram requests per second of mirror')
+    parser.add_argument('--inst-budget', type=int, default=100000, help='hourly Instagram request budget')
+    parser.add_argument('--vk-latency', type=float, default=0.02, help='mean VK latency in seconds')
+    parser.add_argument('--vk-error-rate', type=float, default=0.0, help='share of failed VK requests')
+    parser.add_argument('--vk-flood-rate', type=float, default=0.0,
+                        help='share of VK API requests answered with flood control')
+    parser.add_argument('--vk-api-rps', type=float, default=25.0, help='VK API requests per second of server')
+    parser.add_argument('--vk-upload-rps', type=float, default=50.0, help='VK uploads per second of server')
+    parser.add_argument('--vk-rate', type=float, default=20.0, help='VK API requests per second of mirror')
+    parser.add_argument('--no-execute-batching', action='store_true',
+                        help='send every VK API call with its own request')
+    parser.add_argument('--scaling', type=int, nargs='+', metavar='PROFILES',
+                        help='also run modes for every number of profiles to see how peak memory grows')
+    parser.add_argument('--output', default='benchmark.json', help='file to write results to')
+    parser.add_argument('--compare', metavar='PATH', help='results of previous benchmark to compare with')
+    parser.add_argument('--verbose', action='store_true', help='show output of mirror')
+    args = parser.parse_args()
+
+    workload = Workload(args.profiles, args.posts, args.stories, args.media_per_post,
+                        args.video_share, args.image_side, args.video_size, args.seed)
+    runs = run_workload(workload, args)
+
+    results = {
+        **git_revision(),
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'workload': workload._asdict(),
+        'arguments': vars(args),
+        'summary': summarize(runs),
+        'runs': runs,
+    }
+    if args.scaling:
+        results['scaling'] = {
+            count: summarize(run_workload(workload._replace(profiles=count), args))
+            for count in args.scaling}
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as file:
+            stored = json.load(file)
+        baseline = stored['summary']
+        print(f'Baseline {stored["commit"]}, current {results["commit"]}')
+    report(results['summary'], baseline)
+    if args.scaling:
+        report_scaling(results['scaling'])
+    print(f'Results written to {args.output}')
@@ -1,575 +1,3287 @@
-from datetime import datetime
-from typing import Callable, Tuple
-import asyncio
-import base64
-import math
-import os
-import shutil
-import time
-
-import aiohttp
-import instaloader
-import pandas as pd
-import vk_api
-
-
-CFG_PATH_VK = 'cfg_1'
-CFG_PATH_INST = 'cfg_2'
-LAST_START_PATH = 'cfg_0'
-INST_SESSION_PATH = 'cfg_3'
-
-
-class AsyncWorker():
-    def __init__(self, data: list, func: Callable[..., None], num_workers: int = 4) -> None:
-        """Class which asynchronically aplies provided function to given list.
-
-        Args:
-            data (list): Data to be working with.
-            func (Callable[..., None]): Async function which will be applied.
-            num_workers (int, optional): Number of parallel workers. Defaults to 4.
-        """
-        self.num_workers = num_workers
-        self.futures = list()
-        self.data = data
-        self.func = func
-        asyncio.get_event_loop().run_until_complete(self.start_async())
-
-    async def start_async(self) -> None:
-        """Applying function to list"""
-        ranges = math.ceil(len(self.data)/self.num_workers)
-
-        for worker in range(self.num_workers):
-            batch = self.data[ranges*worker: ranges*(worker+1)]
-            self.futures.append(asyncio.ensure_future(self.func(batch)))
-
-        for future in self.futures:
-            await future
-
-
-class DataPreparer():
-    def __init__(self) -> None:
-        """Class to handle login to VK, Instagram,
-        storing and manipulating time of previous application start
-        and getting links of Instagram pages and VK groups.
-        """
-        self.vk_login = None
-        self.vk_pass = None
-        self.vk_session = None
-
-        self.inst_login = None
-        self.inst_pass = None
-        self.inst_session = None
-
-        self.links = None
-        self.broken_links = list()
-
-        self.date_now = datetime.utcnow()
-        self.last_start_date = self.get_last_start_date()
-
-        if self.vk_connection() & self.inst_connection() & self.load_links():
-            print('OK!')
-
-    def vk_connection(self) -> bool:
-        """Establishing connection to VK.
-
-        Returns:
-            bool: True if connection is OK, False otherwise.
-        """
-        self.get_credentials(CFG_PATH_VK, 'VK')
-
-        if self.vk_auth():
-            print('VK login ok!')
-            return True
-        print('VK login failed!')
-        return False
-
-    def get_credentials(self, path: str, mode: str) -> None:
-        """Getting credentials if they exists, otherwise
-        asking user to write them in console and then storing them to file.
-        If user provided broken credentials deleting file which holds credentials.
-
-        Args:
-            path (str): path to credentials, provided as module constant.
-            mode (str): type of credentials to work with: VK or INST.
-        """
-        if os.path.exists(path):
-            with open(path) as file:
-                row = file.readline()
-                try:
-                    login, passw = base64.b64decode(
-                        row).decode('utf-8').split(',')
-                except ValueError:
-                    os.remove(path)
-        else:
-            login = input('Write login to '+mode+': ')
-            passw = input('Write pass to '+mode+': ')
-            with open(path, 'w') as file:
-                file.write(base64.b64encode(
-                    (login+','+passw).encode('utf-8')).decode('utf-8'))
-
-        if mode == 'VK':
-            self.vk_login = login
-            self.vk_pass = passw
-        else:
-            self.inst_login = login
-            self.inst_pass = passw
-
-    def captcha_handler(self, captcha):
-        """ При возникновении капчи вызывается эта функция и ей передается объект
-            капчи. Через метод get_url можно получить ссылку на изображение.
-            Через метод try_again можно попытаться отправить запрос с кодом капчи
-        """
-
-        key = input("Enter captcha code {0}: ".format(captcha.get_url())).strip()
-
-        # Пробуем снова отправить запрос с капчей
-        return captcha.try_again(key)
-
-    
-    def auth_handler(self):
-        code = input("Код для двухфакторной аутентификации: ")
-        return code, True
-
-
-    def vk_auth(self) -> bool:
-        """Authenticating to VK.
-
-        Returns:
-            bool: True if Auth is done correctly, False otherwise.
-        """
-        self.vk_session = vk_api.VkApi(self.vk_login, self.vk_pass, auth_handler = self.auth_handler, captcha_handler = self.captcha_handler)
-
-        try:
-            self.vk_session.auth()
-            return True
-        except vk_api.exceptions.AuthError as e:
-            print(e)
-            os.remove(CFG_PATH_VK)
-            return False
-
-    def inst_connection(self) -> bool:
-        """Establishing connection to Instagram.
-
-        Returns:
-            bool: True if connection is OK, False otherwise.
-        """
-        self.get_credentials(CFG_PATH_INST, 'INST')
-
-        if self.inst_auth():
-            print('Instagram login ok!')
-            return True
-        print('Instagram login failed!')
-        return False
-
-    def inst_auth(self) -> bool:
-        """Authenticating to Instagram.
-
-        Returns:
-            bool: True if Auth is done correctly, False otherwise.
-        """
-        self.inst_session = instaloader.Instaloader(
-            download_video_thumbnails=False,
-            download_geotags=False,
-            download_comments=False,
-            save_metadata=False,
-            request_timeout=3,
-        )
-
-        if os.path.exists(INST_SESSION_PATH):
-            try:
-                self.inst_session.load_session_from_file(self.inst_login, filename=INST_SESSION_PATH)
-            except Exception:
-                os.remove(INST_SESSION_PATH)
-            return True
-        else:
-            try:
-                self.inst_session.login(self.inst_login, self.inst_pass)
-                self.inst_session.save_session_to_file(filename=INST_SESSION_PATH)
-                return True
-            except instaloader.exceptions.InstaloaderException:
-                os.remove(CFG_PATH_INST)
-                return False
-
-    def load_links(self) -> bool:
-        """Loading file with provided links to Instagram profiles and VK albums.
-
-        Returns:
-            bool: True if file loaded correctly, False otherwise.
-        """
-        try:
-            self.links = pd.read_csv('Links.csv', delimiter=';')
-            return True
-        except OSError:
-            links = pd.DataFrame(
-                {'Instagram Link': ['https://www.instagram.com/PLACE_NAME_1/',
-                                    'https://www.instagram.com/PLACE_NAME_2/'],
-                 'VK album link post photo': ['https://vk.com/album-PLACE_LINK_1',
-                                              'https://vk.com/album-PLACE_LINK_2'],
-                 'VK album link stories photo': ['https://vk.com/album-PLACE_LINK_1',
-                                                 'https://vk.com/album-PLACE_LINK_2'],
-                 'VK album link video': ['https://vk.com/videos-PLACE_LINK_1?section=album_PLACE_LINK_1',
-                                         'https://vk.com/videos-PLACE_LINK_2?section=album_PLACE_LINK_2']
-                 }
-            )
-            links.to_csv('Links.csv', index=False)
-            print('Add your links to Links.csv!')
-            return False
-
-    def check_links(self) -> bool:
-        """Checking provided links on their accesibility.
-        Not using now because instagram limits amount of page loads and
-        this function is too costly in this term.
-
-        Returns:
-            bool: True if check is done, False otherwise.
-        """
-        links_last_change = datetime.fromtimestamp(
-            os.path.getmtime('Links.csv'))
-        days_delta = (datetime.now() - links_last_change).days
-        if days_delta >= 0:
-            return True
-        AsyncWorker(self.links.values.ravel(), self.response_check, 1)
-        if self.broken_links != list():
-            print('Change these links:')
-            for url in self.broken_links:
-                print(url)
-            return False
-        print('Links ok!')
-        return True
-
-    async def response_check(self, links: list) -> None:
-        """Async function to be given to AsyncWorker class.
-
-        Args:
-            links (list): List of links to be checked on availability.
-        """
-        async with aiohttp.ClientSession(trust_env=True) as client:
-            for url in links:
-                async with client.get(aiohttp.client.URL(url, encoded=True)) as response:
-                    if response.status == 429:
-                        print(
-                            'The maximum number of requests per hour has been exceeded. Instagram banned you')
-                        self.broken_links.append(' ')
-                        break
-                    if response.status not in range(200, 300):
-                        self.broken_links.append(url)
-                    await asyncio.sleep(0.5)
-
-    def get_last_start_date(self) -> datetime:
-        """Getting last start date of module if file exists,
-        otherwise creating file and writing time.
-
-        Returns:
-            datetime: UTC time of last module start if ISO format.
-        """
-        if os.path.exists(LAST_START_PATH):
-            with open(LAST_START_PATH) as file:
-                last_start_date = datetime.fromisoformat(file.read())
-                return last_start_date
-        else:
-            with open(LAST_START_PATH, 'w') as file:
-                file.write(str(self.date_now.isoformat()))
-                return self.date_now
-
-
-class InstagramDownloader:
-    def __init__(self,
-                 instagram_session: instaloader.instaloader.Instaloader,
-                 links: pd.DataFrame,
-                 last_date: datetime,
-                 date_now: datetime) -> None:
-        """Class to download new posts and stories from provided page links
-        between last start date of module and now.
-
-        Args:
-            instagram_session (instaloader.instaloader.Instaloader): Instagram session which will be used to download stories.
-            links (pd.DataFrame): Dataframe with provided links to Instagram pages and VK albums.
-            last_date (datetime): Last date of module start.
-            date_now (datetime): Current date of module start.
-        """
-        self.inst_session = instagram_session
-        self.links = links
-        self.last_date = last_date
-        self.date_now = date_now
-
-        self.profile_ids = list()
-        self.pages = self.get_pages()
-
-        print(f'Last downloading date: {self.last_date}!')
-        self.folder_counter = self.get_last_folder_counter()
-        self.download_posts()
-        self.download_stories()
-        self.update_last_start_date()
-
-    def get_pages(self) -> list:
-        """Get usenames from provided instagram pages.
-
-        Returns:
-            list: List of instagram usernames.
-        """
-        pages = self.links['Instagram Link'].apply(
-            lambda x: x.split('/')[3]).values
-        return pages
-
-    def download_posts(self) -> None:
-        """Download new Instagram posts.
-        """
-        print('Getting posts!')
-        for page in self.pages:
-            profile = instaloader.Profile.from_username(
-                self.inst_session.context, page)
-            self.profile_ids.append(profile.userid)
-            posts = profile.get_posts()
-            print(page)
-            for post in posts:
-                if self.last_date < post.date:
-                    self.inst_session.download_post(
-                        post, f"{self.folder_counter}_posts:{page}")
-                    self.folder_counter += 1
-                else:
-                    break
-
-    def download_stories(self) -> None:
-        """Download new Instagram stories.
-        """
-        print('Getting stories!')
-        for story in self.inst_session.get_stories(self.profile_ids):
-            username = story.owner_profile.username
-            video_required = self.links.loc[self.links['Instagram Link'] ==
-                                            f'https://www.instagram.com/{username}/', 'VK album link stories video'].notna().item()
-            print(username)
-            for item in story.get_items():
-                # Bound by date of last script start
-                if self.last_date < item.date:
-                    # Not downloading video from instagram pages without VK story video link
-                    if video_required or not item.is_video:
-                        self.inst_session.download_storyitem(
-                            item, f'{self.folder_counter}_stories:{username}')
-                        self.folder_counter += 1
-                else:
-                    break
-
-    def update_last_start_date(self) -> None:
-        """Updating time of module last start date after finishing downloading new posts and stories
-        """
-        with open(LAST_START_PATH, 'w') as file:
-            file.write(str(self.date_now.isoformat()))
-
-    @staticmethod
-    def get_last_folder_counter() -> int:
-        """If there are folders which were not uploaded to VK and hence deleted
-        then to keep them in order and not override
-        start naming new folders with value of last created folder +1
-
-        Returns:
-            int: number to start naming with.
-        """
-        folders = DataCollector.get_folders()
-        last_folder = 0
-        for folder in folders:
-            temp = int(folder[0].split('_')[0])
-            if temp > last_folder:
-                last_folder = temp
-
-        return last_folder+1
-
-
-class DataCollector:
-    def __init__(self, links: pd.DataFrame) -> None:
-        """Collecting all downladed files and sorting them by type
-        to feed into VKUploader class.
-
-        Args:
-            links (pd.DataFrame): Dataframe with provided links to Instagram pages and VK albums.
-        """
-        self.links = links
-        self.videos = list()
-        self.images = list()
-
-        print('Fetching files!')
-        self.get_files_to_upload()
-
-    def get_links(self, username: str, is_post: bool) -> Tuple[str, str, str, str]:
-        """Get VK group and album ids for image and video files for provided username and type of post.
-
-        Args:
-            username (str): Instagram username.
-            is_post (bool): True if need links to upload Instagram post, False if uploading stories.
-
-        Returns:
-            Tuple[str, str, str, str]: Tuple of ids to VK folders.
-        """
-        col_name = 'post' if is_post else 'stories'
-        vk_image_group, vk_image_album = self.links.loc[self.links['Instagram Link'] ==
-                                                        f'https://www.instagram.com/{username}/', f'VK album link {col_name} photo'].item().split('-')[1].split('_')
-        try:
-            vk_video_temp = self.links.loc[self.links['Instagram Link'] ==
-                                           f'https://www.instagram.com/{username}/', f'VK album link {col_name} video'].item().split('-')[1]
-            vk_video_group = vk_video_temp.split('?')[0]
-            vk_video_album = vk_video_temp.split('_')[1]
-        except AttributeError:
-            vk_video_group = vk_video_album = None
-
-        return vk_image_group, vk_image_album, vk_video_group, vk_video_album
-
-    @staticmethod
-    def get_description(folder: str) -> str:
-        """Get descriprion if it exists for downloaded post.
-
-        Args:
-            folder (str): folder to be searched.
-
-        Returns:
-            str: Description.
-        """
-        picture_description = None
-        for item in os.listdir(folder):
-            if '.txt' in item:
-                path = folder+'/'+item
-                with open(path, encoding='UTF-8') as file:
-                    picture_description = file.read()
-        return picture_description
-
-    @staticmethod
-    def get_folders() -> list:
-        """Get folder names which were created by InstagramDownloader class.
-
-        Returns:
-            list: List of str paths to folders with donwloaded data.
-        """
-        folders = list()
-        for element in os.listdir():
-            if '：' in element:
-                folders.append(element)
-        return folders
-
-    def get_files_to_upload(self) -> None:
-        """Getting and sorting tuples
-            (path, video_name, description, vk_video_group, vk_video_album) for videos
-            (path, description, vk_image_group, vk_image_album) for images.
-        """
-        folders = self.get_folders()
-
-        for folder in folders:
-            is_post = 'posts：' in folder
-            username = folder.split('：')[1]
-            vk_image_group, vk_image_album, vk_video_group, vk_video_album = self.get_links(
-                username, is_post)
-
-            description = self.get_description(folder)
-
-            for item in os.listdir(folder):
-                path = folder+'/'+item
-                date = item[2:10].replace('-', '')
-                if '.mp4' in item:
-                    addition = f' Instagram @{username}' if is_post else ' Instagram stories'
-                    video_name = date+addition
-                    self.videos.append(
-                        (path, video_name, description, vk_video_group, vk_video_album))
-                elif '.jpg' in item:
-                    self.images.append(
-                        (path, description, vk_image_group, vk_image_album))
-
-        self.images = self.sort_folders(self.images)
-        self.videos = self.sort_folders(self.videos)
-
-    @staticmethod
-    def sort_folders(folders: list) -> list:
-        """
-
-        Args:
-            folders (list): List of str paths to be sorted based on their folder counter.
-
-        Returns:
-            list: Sorted list of str paths.
-        """
-        sorted_folder = sorted(folders, key=lambda x: int(x[0].split('_')[0]))
-        return sorted_folder
-
-
-class VKUploader:
-    def __init__(self, vk_session: vk_api.vk_api.VkApi, images: list, videos: list) -> None:
-        """Class to upload data to VK.
-
-        Args:
-            vk_session (vk_api.vk_api.VkApi): Session with access to provided VK group folders.
-            images (list): List of tuples with information about images to be uploaded in type
-            (path, description, vk_image_group, vk_image_album).
-            videos (list): List of tuples with information about videos to be uploaded in type
-            (path, video_name, description, vk_video_group, vk_video_album).
-        """
-        self.vk_session = vk_session
-        self.upload = vk_api.VkUpload(self.vk_session)
-        self.images = images
-        self.videos = videos
-
-        self.image_uploader()
-        self.video_uploader()
-        self.folder_remover()
-
-    def image_uploader(self) -> None:
-        """Image uploader to VK. Deletes file after correct uploading.
-        """
-        for item in self.images:
-            cap = None
-            if item[1] is not None:
-                cap = item[1].replace('@', '@ ')
-
-            photo = self.upload.photo(
-                photos=item[0],
-                caption=cap,
-                group_id=item[2],
-                album_id=item[3]
-            )
-            vk_photo_url = 'https://vk.com/photo{}_{}'.format(
-                photo[0]['owner_id'], photo[0]['id'])
-            profile_info = item[0].split('/')[0]
-            print('\n'+f'{profile_info} Vk upload done to {vk_photo_url}'+'\n')
-
-            os.remove(item[0])
-
-    def video_uploader(self) -> None:
-        """Video uploader to VK. Deletes file after correct uploading.
-        """
-        for item in self.videos:
-            desc = None
-            if item[2] is not None:
-                desc = item[2].replace('@', '@ ')
-
-            video = self.upload.video(
-                video_file=item[0],
-                name=item[1],
-                description=desc,
-                group_id=item[3],
-                album_id=item[4]
-            )
-            vk_video_url = 'https://vk.com/video{}_{}'.format(
-                video['owner_id'], video['video_id'])
-            profile_info = item[0].split('/')[0]
-            print('\n'+f'{profile_info} Vk upload done to {vk_video_url}'+'\n')
-
-            os.remove(item[0])
-            time.sleep(3)
-
-    @staticmethod
-    def folder_remover() -> None:
-        """Delets folders in which there are no files of type mp4 and jpg.
-        """
-        for element in os.listdir():
-            if '：' in element:
-                delete_folder = True
-                for item in os.listdir(element):
-                    if ('.mp4' or '.jpg') in item:
-                        delete_folder = False
-                if delete_folder:
-                    shutil.rmtree(element)
-
-
-if __name__ == '__main__':
-    data = DataPreparer()
-    InstagramDownloader(data.inst_session, data.links,
-                        data.last_start_date, data.date_now)
-    fetched = DataCollector(data.links)
-    VKUploader(data.vk_session, fetched.images, fetched.videos)
-    print('Uploading done!')
-    input()
+from __future__ import annotations
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from typing import TYPE_CHECKING, BinaryIO, Callable, NamedTuple, Tuple
+import argparse
+import asyncio
+import base64
+import csv
+import hashlib
+import importlib.util
+import io
+import json
+import math
+import os
+import queue
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# Heavy modules are imported by phases which use them, so quiet cycles and --help start fast
+if TYPE_CHECKING:
+    import instaloader
+    import requests
+    import vk_api
+
+
+CFG_PATH_VK = 'cfg_1'
+CFG_PATH_INST = 'cfg_2'
+LINKS_PATH = 'Links.csv'
+LINKS_COLUMNS = ('Instagram Link',
+                 'VK album link post photo', 'VK album link post video',
+                 'VK album link stories photo', 'VK album link stories video')
+LAST_START_PATH = 'cfg_0'
+INST_SESSION_PATH = 'cfg_3'
+LEDGER_PATH = 'cfg_4'
+CURSORS_PATH = 'cfg_5'
+PROFILE_CACHE_PATH = 'cfg_6'
+BUDGET_PATH = 'cfg_7'
+VIDEO_PROGRESS_PATH = 'cfg_8'
+LINK_HEALTH_PATH = 'cfg_9'
+SPOOL_DIR = 'spool'
+METRICS_PATH = 'metrics.jsonl'
+IMAGE_CACHE_DIR = os.path.join(SPOOL_DIR, '.cache')
+# Files which failed to upload JOB_MAX_ATTEMPTS times are moved here
+DEAD_LETTER_DIR = os.path.join(SPOOL_DIR, '.dead')
+
+DOWNLOAD_WORKERS = 4
+INST_REQUESTS_PER_SECOND = 1.0
+FOLDER_COUNTER_RANGE = 10000
+# How far back pages newly added to Links.csv are downloaded
+NEW_PROFILE_LOOKBACK = timedelta(days=1)
+PROFILE_CACHE_TTL = timedelta(days=7)
+# Instagram bans accounts making too many requests per hour
+INST_HOURLY_BUDGET = 200
+# Expected requests for polling posts of single page
+PAGE_POLL_COST = 2
+POLL_INTERVAL_MIN = timedelta(minutes=15)
+POLL_INTERVAL_MAX = timedelta(days=1)
+DAEMON_INTERVAL = timedelta(minutes=30)
+# Upper bounds of request latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PIPELINE_QUEUE_SIZE = 8
+# Profiles which stories are requested and processed at once
+STORY_CHUNK_SIZE = 20
+UPLOAD_WORKERS = 4
+VK_PHOTOS_PER_UPLOAD = 5
+JOB_MAX_ATTEMPTS = 5
+# Failed upload is retried after base time doubled with every failure
+JOB_RETRY_BASE = timedelta(minutes=10)
+JOB_RETRY_MAX = timedelta(hours=12)
+VIDEO_UPLOAD_WORKERS = 2
+VIDEO_CHUNK_SIZE = 5*1024*1024
+# Bytes per second shared by all video uploads, None means no cap
+VIDEO_BANDWIDTH = None
+# Media larger than threshold is spooled to temporary file in zero disk mode
+STREAM_SPOOL_THRESHOLD = 16*1024*1024
+STREAM_CHUNK_SIZE = 256*1024
+# VK stores images downscaled to 2560 px by longest side
+VK_MAX_IMAGE_SIDE = 2560
+IMAGE_QUALITY = 87
+IMAGE_CACHE_TTL = timedelta(days=7)
+# Maximal number of different bits of perceptual hashes of similar images
+PHASH_DISTANCE = 4
+# Perceptual hashes with fewer set or unset bits belong to low-detail images, like text on plain background,
+# which hash the same even if they are different
+PHASH_MIN_BITS = 8
+# VK allows 3 API requests per second for user token
+VK_API_RATE = 3.0
+VK_MIN_RATE = 0.1
+# Too many requests per second and flood control
+VK_THROTTLE_CODES = (6, 9)
+VK_THROTTLE_RETRIES = 6
+VK_BACKOFF_BASE = 1.0
+VK_BACKOFF_MAX = 60.0
+
+# Seconds after which link check is cancelled
+LINK_CHECK_TIMEOUT = 30.0
+LINK_HEALTH_TTL = timedelta(days=1)
+# Instagram profiles checked per start, other stale profiles are checked on next starts
+INST_LINK_CHECKS = 5
+# Link checks running at once by host
+LINK_CHECK_HOST_LIMITS = MappingProxyType({'instagram': 1, 'vk': 2})
+# VK allows up to 25 API calls in single execute request
+VK_EXECUTE_LIMIT = 25
+# Seconds calls wait for other calls to be sent with them in single execute request
+VK_BATCH_WINDOW = 0.05
+VK_BATCHED_METHODS = ('photos.getUploadServer', 'photos.save', 'video.save', 'video.addToAlbum',
+                      'photos.getAlbums', 'video.getAlbumById')
+
+INST_LINK_PATTERN = re.compile(r'https?://(?:www\.)?instagram\.com/([^/?#]+)')
+VK_PHOTO_ALBUM_PATTERN = re.compile(r'album-(\d+)_(\d+)')
+VK_VIDEO_ALBUM_PATTERN = re.compile(r'videos-(\d+)\?section=album_(\d+)')
+
+
+class WorkResult(NamedTuple):
+    """Result of function applied to single item by AsyncWorker."""
+    item: object
+    result: object
+    # None if function returned result
+    error: BaseException
+
+
+class AsyncWorker():
+    def __init__(self,
+                 data: list,
+                 func: Callable[..., object],
+                 num_workers: int = 4,
+                 host: Callable[[object], str] = None,
+                 host_limits: dict = None,
+                 timeout: float = None,
+                 stop_on: tuple = ()) -> None:
+        """Class which asynchronically aplies provided function to every item of given list.
+        Workers take items from queue of their host, so slow item holds up only its own worker
+        and items of host which reached its limit do not hold up items of other hosts.
+        Exception of single item is stored as its result and does not stop other items.
+
+        Args:
+            data (list): Data to be working with.
+            func (Callable[..., object]): Function which will be applied to every item. Async function
+            is awaited, plain function is run in thread.
+            num_workers (int, optional): Number of items processed at once. Defaults to 4.
+            host (Callable[[object], str], optional): Function which gets host of item. Defaults to None,
+            which means all items have the same host.
+            host_limits (dict, optional): Maximum number of items processed at once by host,
+            hosts which are not in dict are limited only by num_workers. Defaults to None.
+            timeout (float, optional): Seconds after which item is failed with asyncio.TimeoutError.
+            Plain function can not be interrupted, it keeps running in its thread after that,
+            but AsyncWorker does not wait for it. Defaults to None, which means no timeout.
+            stop_on (tuple, optional): Exception types after which items of the same host which are not started yet
+            are cancelled with asyncio.CancelledError. Defaults to ().
+        """
+        self.num_workers = num_workers
+        self.data = list(data)
+        self.func = func
+        self.host = host
+        self.host_limits = host_limits if host_limits is not None else dict()
+        self.timeout = timeout
+        self.stop_on = stop_on
+        # Results in order of data
+        self.results = list()
+        # Own executor instead of default one, as asyncio.run waits for threads of default executor.
+        # Thread of timed out item stays busy, so every item may need its own thread
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.data)))
+        try:
+            asyncio.run(self.start_async())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    @property
+    def errors(self) -> list:
+        """Exceptions of items which failed."""
+        return [result.error for result in self.results if result.error is not None]
+
+    async def start_async(self) -> None:
+        """Applying function to list"""
+        self.results = [None]*len(self.data)
+        # Hosts which items are cancelled after stop_on exception
+        self.stopped = set()
+        self.slots = asyncio.Semaphore(self.num_workers)
+        hosts = dict()
+        for number, item in enumerate(self.data):
+            host = self.host(item) if self.host is not None else None
+            hosts.setdefault(host, asyncio.Queue()).put_nowait((number, item))
+
+        workers = [asyncio.create_task(self.worker(host, items))
+                   for host, items in hosts.items()
+                   for _ in range(min(self.host_limits.get(host, self.num_workers), items.qsize()))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def worker(self, host: str, items: asyncio.Queue) -> None:
+        """Taking items of host from queue and applying function to them one by one.
+
+        Args:
+            host (str): Host of items.
+            items (asyncio.Queue): Queue of tuples (number, item).
+        """
+        while not items.empty():
+            number, item = items.get_nowait()
+            async with self.slots:
+                if host in self.stopped:
+                    self.results[number] = WorkResult(item, None, asyncio.CancelledError())
+                    continue
+                try:
+                    result = await asyncio.wait_for(self.call(item), self.timeout)
+                except Exception as e:
+                    if isinstance(e, self.stop_on):
+                        self.stopped.add(host)
+                    self.results[number] = WorkResult(item, None, e)
+                else:
+                    self.results[number] = WorkResult(item, result, None)
+
+    async def call(self, item: object) -> object:
+        """Applying function to single item.
+
+        Args:
+            item (object): Item of data.
+
+        Returns:
+            object: Result of function.
+        """
+        if asyncio.iscoroutinefunction(self.func):
+            return await self.func(item)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.func, item)
+
+
+class TokenBucket():
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        """Thread safe token bucket which is shared between workers
+        to keep their overall request rate under provided limit.
+
+        Args:
+            rate (float): Amount of tokens added to bucket per second.
+            capacity (float, optional): Maximum amount of stored tokens. Defaults to 1.0.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Taking tokens from bucket. If there are not enough of them
+        tokens are reserved and caller sleeps until they are refilled.
+
+        Args:
+            amount (float, optional): Amount of tokens to take. Defaults to 1.0.
+
+        Returns:
+            float: Time in seconds spent waiting.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.last_refill)*self.rate)
+            self.last_refill = now
+            self.tokens -= amount
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Metrics():
+    def __init__(self, path: str = METRICS_PATH, prometheus_path: str = None) -> None:
+        """Collecting wall time of stages, latency histograms of requests, transferred bytes,
+        retries and rate limit waits of single cycle. Metrics are appended to JSON lines file
+        after every cycle and optionally written in Prometheus text format.
+
+        Args:
+            path (str, optional): Path to JSON lines file. Defaults to METRICS_PATH.
+            prometheus_path (str, optional): Path to Prometheus text file. Defaults to None, which means not writing it.
+        """
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Removing metrics of previous cycle.
+        """
+        with self.lock:
+            self.stages = dict()
+            self.running = dict()
+            self.latencies = dict()
+            self.counters = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measuring wall time of stage, can be used as decorator. Time when several calls
+        of the same stage are running at once is counted once, so stage time is never longer than cycle.
+
+        Args:
+            name (str): Stage name.
+        """
+        with self.lock:
+            calls, started = self.running.get(name, (0, time.perf_counter()))
+            self.running[name] = (calls + 1, started)
+        try:
+            yield
+        finally:
+            with self.lock:
+                calls, started = self.running.pop(name)
+                if calls > 1:
+                    self.running[name] = (calls - 1, started)
+                else:
+                    self.stages[name] = self.stages.get(
+                        name, 0.0) + time.perf_counter() - started
+
+    @contextmanager
+    def request(self, name: str):
+        """Measuring latency of single request.
+
+        Args:
+            name (str): Request type.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Adding request latency to histogram.
+
+        Args:
+            name (str): Request type.
+            seconds (float): Latency in seconds.
+        """
+        with self.lock:
+            histogram = self.latencies.setdefault(
+                name, {'buckets': [0]*(len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0})
+            bucket = next((number for number, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+                          len(LATENCY_BUCKETS))
+            histogram['buckets'][bucket] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Adding value to counter, for example transferred bytes or retries.
+
+        Args:
+            name (str): Counter name.
+            value (float, optional): Value to be added. Defaults to 1.
+        """
+        if value:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def write(self) -> None:
+        """Appending metrics of cycle to JSON lines file and writing Prometheus text file if path is provided.
+        """
+        with self.lock:
+            record = {'time': datetime.utcnow().isoformat(),
+                      'stages': dict(self.stages),
+                      'latencies': {name: {'le': list(LATENCY_BUCKETS) + ['+Inf'], **histogram}
+                                    for name, histogram in self.latencies.items()},
+                      'counters': dict(self.counters)}
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+        if self.prometheus_path is not None:
+            temp_path = self.prometheus_path + '.tmp'
+            with open(temp_path, 'w') as file:
+                file.write(self.prometheus_text(record))
+            os.replace(temp_path, self.prometheus_path)
+
+    @staticmethod
+    def prometheus_text(record: dict) -> str:
+        """Get metrics of cycle in Prometheus text format.
+
+        Args:
+            record (dict): Metrics of cycle.
+
+        Returns:
+            str: Metrics in Prometheus text format.
+        """
+        lines = ['# TYPE instagram_to_vk_stage_seconds gauge']
+        for name, seconds in record['stages'].items():
+            lines.append(f'instagram_to_vk_stage_seconds{{stage="{name}"}} {seconds}')
+        lines.append('# TYPE instagram_to_vk_request_seconds histogram')
+        for name, histogram in record['latencies'].items():
+            total = 0
+            for bound, count in zip(histogram['le'], histogram['buckets']):
+                total += count
+                lines.append(
+                    f'instagram_to_vk_request_seconds_bucket{{request="{name}",le="{bound}"}} {total}')
+            lines.append(f'instagram_to_vk_request_seconds_sum{{request="{name}"}} {histogram["sum"]}')
+            lines.append(f'instagram_to_vk_request_seconds_count{{request="{name}"}} {histogram["count"]}')
+        # Counters are reset every cycle, so they are exposed as gauges of last cycle
+        lines.append('# TYPE instagram_to_vk_last_cycle gauge')
+        for name, value in record['counters'].items():
+            lines.append(f'instagram_to_vk_last_cycle{{metric="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    def __init__(self, rate: float = VK_API_RATE, min_rate: float = VK_MIN_RATE) -> None:
+        """Token bucket for VK API calls which slows down after VK throttling errors
+        and returns to documented limit while requests succeed.
+
+        Args:
+            rate (float, optional): Maximum requests per second. Defaults to VK_API_RATE.
+            min_rate (float, optional): Minimum requests per second after throttling. Defaults to VK_MIN_RATE.
+        """
+        super().__init__(rate)
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.throttle_events = 0
+
+    @property
+    def effective_rate(self) -> float:
+        """Current allowed requests per second."""
+        return self.rate
+
+    def success(self) -> None:
+        """Speeding up after successful request until documented limit is reached.
+        """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate*1.1)
+
+    def throttle(self, attempt: int) -> float:
+        """Halving rate and sleeping exponentially growing time with jitter after throttling error.
+
+        Args:
+            attempt (int): Number of throttling errors in a row for current request.
+
+        Returns:
+            float: Time in seconds spent sleeping.
+        """
+        with self.lock:
+            self.throttle_events += 1
+            self.rate = max(self.min_rate, self.rate/2)
+        wait = min(VK_BACKOFF_MAX, VK_BACKOFF_BASE*2**attempt)
+        wait *= random.uniform(0.5, 1.0)
+        time.sleep(wait)
+        return wait
+
+    def install(self, vk_session: vk_api.vk_api.VkApi) -> None:
+        """Routing all API calls of VK session including calls made by VkUpload through this limiter.
+
+        Args:
+            vk_session (vk_api.vk_api.VkApi): Session to be limited.
+        """
+        import vk_api
+
+        method = vk_session.method
+
+        def limited_method(*args, **kwargs):
+            attempt = 0
+            while True:
+                METRICS.count('vk_rate_limit_wait_seconds', self.acquire())
+                try:
+                    with METRICS.request('vk_api'):
+                        response = method(*args, **kwargs)
+                except vk_api.exceptions.ApiError as e:
+                    if e.code not in VK_THROTTLE_CODES or attempt == VK_THROTTLE_RETRIES:
+                        raise
+                    METRICS.count('vk_retries')
+                    METRICS.count('vk_rate_limit_wait_seconds', self.throttle(attempt))
+                    attempt += 1
+                    continue
+                self.success()
+                return response
+
+        # Limiter paces requests itself instead of fixed delays of vk_api
+        vk_session.error_handlers.pop(vk_api.vk_api.TOO_MANY_RPS_CODE, None)
+        vk_session.RPS_DELAY = 0
+        vk_session.method = limited_method
+        vk_session.rate_limit = self
+
+
+class ExecuteBatcher():
+    def __init__(self,
+                 window: float = VK_BATCH_WINDOW,
+                 limit: int = VK_EXECUTE_LIMIT,
+                 methods: tuple = VK_BATCHED_METHODS) -> None:
+        """Gathering VK API calls made at the same time by several threads and sending them
+        with single execute request. Every caller waits for result of its own call.
+        First pending call waits window seconds for other calls. Only one request is sent at once,
+        calls made while it waits for rate limit or response are sent with next request.
+
+        Args:
+            window (float, optional): Seconds to gather calls. Defaults to VK_BATCH_WINDOW.
+            limit (int, optional): Maximum calls in single execute request. Defaults to VK_EXECUTE_LIMIT.
+            methods (tuple, optional): Methods which are gathered, other calls are sent at once. Defaults to VK_BATCHED_METHODS.
+        """
+        self.window = window
+        self.limit = limit
+        self.methods = methods
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        # Tuples (method, values, future)
+        self.pending = list()
+        self.timer = None
+        self.vk_session = None
+        self.method = None
+        self.calls = 0
+        self.requests = 0
+
+    def install(self, vk_session: vk_api.vk_api.VkApi) -> None:
+        """Routing calls of gathered methods of VK session including calls made by VkUpload through this batcher.
+        Should be installed after AdaptiveRateLimiter, so every execute request is limited and retried as single call.
+
+        Args:
+            vk_session (vk_api.vk_api.VkApi): Session to be batched.
+        """
+        method = vk_session.method
+
+        def batched_method(name, values=None, *args, **kwargs):
+            if name not in self.methods or args or kwargs:
+                return method(name, values, *args, **kwargs)
+            return self.submit(name, values).result()
+
+        self.vk_session = vk_session
+        self.method = method
+        vk_session.method = batched_method
+        vk_session.batcher = self
+
+    def submit(self, name: str, values: dict) -> Future:
+        """Adding call to pending calls, calls are sent when there are limit of them or window is over.
+
+        Args:
+            name (str): Method name.
+            values (dict): Method parameters.
+
+        Returns:
+            Future: Result of call.
+        """
+        future = Future()
+        with self.lock:
+            self.pending.append((name, values or dict(), future))
+            full = len(self.pending) >= self.limit
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+        return future
+
+    def flush(self) -> None:
+        """Sending pending calls by requests of up to limit calls.
+        """
+        with self.send_lock:
+            while True:
+                with self.lock:
+                    if self.timer is not None:
+                        self.timer.cancel()
+                        self.timer = None
+                    batch, self.pending = self.pending[:self.limit], self.pending[self.limit:]
+                if not batch:
+                    return
+                self.send(batch)
+
+    def send(self, batch: list) -> None:
+        """Sending calls with single request and passing results to their callers.
+        Failed call returns false inside execute, its error is taken from execute_errors.
+
+        Args:
+            batch (list): Tuples (method, values, future).
+        """
+        import vk_api
+
+        with self.lock:
+            self.calls += len(batch)
+            self.requests += 1
+        METRICS.count('vk_batched_calls', len(batch))
+        METRICS.count('vk_execute_requests')
+        error = None
+        try:
+            if len(batch) == 1:
+                name, values, future = batch[0]
+                future.set_result(self.method(name, values))
+                return
+
+            code = 'return [{}];'.format(','.join(
+                f'API.{name}({json.dumps({key: value for key, value in values.items() if value is not None}, ensure_ascii=False)})'
+                for name, values, _ in batch))
+            response = self.method('execute', {'code': code}, raw=True)
+            errors = iter(response.get('execute_errors', list()))
+            for (name, values, future), result in zip(batch, response['response']):
+                if result is False:
+                    call_error = next(errors, {'error_code': 0, 'error_msg': 'call failed inside execute'})
+                    future.set_exception(vk_api.exceptions.ApiError(
+                        self.vk_session, name, values, False, call_error))
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            error = e
+        finally:
+            # Callers wait for their results without timeout, so every future must be resolved
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error if error is not None else
+                                         RuntimeError('VK execute response has no result of call'))
+
+
+class VKRoute(NamedTuple):
+    """VK group and album ids to upload images and videos of single Instagram page to."""
+    image_group: str
+    image_album: str
+    video_group: str
+    video_album: str
+
+
+class LinkIndex():
+    def __init__(self, links: list) -> None:
+        """Immutable index of VK albums for every Instagram username which is built once from provided links.
+        Rows which could not be parsed are stored in broken_rows and skipped.
+
+        Args:
+            links (list): Rows of links file as dicts by column name.
+        """
+        routes = dict()
+        self.broken_rows = list()
+        # Row numbers as they are shown in file with header
+        for number, row in enumerate(links, start=2):
+            try:
+                username, username_routes = self.parse_row(row)
+            except ValueError as e:
+                self.broken_rows.append(f'Links.csv row {number}: {e}')
+                continue
+            routes[username] = username_routes
+
+        self.routes = MappingProxyType(routes)
+        self.usernames = tuple(routes)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.routes
+
+    def get(self, username: str, is_post: bool) -> VKRoute:
+        """Get VK group and album ids for provided username and type of post.
+
+        Args:
+            username (str): Instagram username.
+            is_post (bool): True if need ids to upload Instagram post, False if uploading stories.
+
+        Returns:
+            VKRoute: Ids of VK albums, video ids are None if there is no video link.
+        """
+        return self.routes[username]['post' if is_post else 'stories']
+
+    @classmethod
+    def parse_row(cls, row: dict) -> Tuple[str, MappingProxyType]:
+        """Parse single row of links file.
+
+        Args:
+            row (dict): Row of links file.
+
+        Raises:
+            ValueError: If Instagram link or any of VK album links is malformed.
+
+        Returns:
+            Tuple[str, MappingProxyType]: Instagram username and its VK routes for posts and stories.
+        """
+        match = INST_LINK_PATTERN.match(str(row.get('Instagram Link')).strip())
+        if match is None:
+            raise ValueError(
+                f'wrong Instagram link {row.get("Instagram Link")}')
+
+        routes = dict()
+        for kind in ('post', 'stories'):
+            image_ids = cls.parse_album(
+                row.get(f'VK album link {kind} photo'), VK_PHOTO_ALBUM_PATTERN, True)
+            video_ids = cls.parse_album(
+                row.get(f'VK album link {kind} video'), VK_VIDEO_ALBUM_PATTERN, False)
+            routes[kind] = VKRoute(*image_ids, *video_ids)
+        return match.group(1), MappingProxyType(routes)
+
+    @staticmethod
+    def parse_album(link: str, pattern: re.Pattern, required: bool) -> Tuple[str, str]:
+        """Parse VK group and album ids from album link.
+
+        Args:
+            link (str): VK album link, None if column is missing.
+            pattern (re.Pattern): Pattern with group and album ids.
+            required (bool): True if link must be provided.
+
+        Raises:
+            ValueError: If link is malformed or required link is missing.
+
+        Returns:
+            Tuple[str, str]: VK group and album ids, (None, None) if optional link is missing.
+        """
+        if not isinstance(link, str) or not link.strip():
+            if required:
+                raise ValueError('VK photo album link is missing')
+            return None, None
+        match = pattern.search(link)
+        if match is None:
+            raise ValueError(f'wrong VK album link {link}')
+        return match.groups()
+
+
+class MirrorLedger():
+    def __init__(self, path: str = LEDGER_PATH) -> None:
+        """Persistent SQLite ledger of Instagram posts and story items which were already downloaded,
+        and of their files which were already uploaded to VK with ids of VK photos and videos.
+
+        Args:
+            path (str, optional): Path to ledger file. Defaults to LEDGER_PATH.
+        """
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.connection.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS media (media_id TEXT PRIMARY KEY, kind TEXT);
+            CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, media_id TEXT);
+            CREATE TABLE IF NOT EXISTS uploads (
+                media_id TEXT, file TEXT, vk_id TEXT, PRIMARY KEY (media_id, file));
+            CREATE TABLE IF NOT EXISTS content (
+                content_hash TEXT, album TEXT, phash TEXT, vk_id TEXT, PRIMARY KEY (content_hash, album));
+            CREATE INDEX IF NOT EXISTS content_album ON content (album);
+            CREATE TABLE IF NOT EXISTS jobs (
+                path TEXT PRIMARY KEY, kind TEXT, attempts INTEGER, next_attempt REAL, state TEXT, error TEXT);
+        ''')
+
+    def execute(self, query: str, parameters: tuple) -> list:
+        """Executing query from any thread.
+
+        Args:
+            query (str): SQL query.
+            parameters (tuple): Query parameters.
+
+        Returns:
+            list: Fetched rows.
+        """
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def is_downloaded(self, media_id: str) -> bool:
+        """Check if post shortcode or story item id was already downloaded.
+
+        Args:
+            media_id (str): Post shortcode or story item id.
+
+        Returns:
+            bool: True if media was downloaded, False otherwise.
+        """
+        return bool(self.execute('SELECT 1 FROM media WHERE media_id = ?', (media_id,)))
+
+    def add_download(self, media_id: str, kind: str, folder: str = None) -> None:
+        """Storing downloaded post or story item and folder it was downloaded into.
+
+        Args:
+            media_id (str): Post shortcode or story item id.
+            kind (str): posts or stories.
+            folder (str, optional): Folder name. Defaults to None if media was not stored on disk.
+        """
+        self.execute('INSERT OR IGNORE INTO media VALUES (?, ?)', (media_id, kind))
+        if folder is not None:
+            # Folder counters start from 1 again after all folders are uploaded
+            self.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)', (folder, media_id))
+
+    def media_id(self, path: str) -> str:
+        """Get media id of post or story item which file was downloaded from.
+
+        Args:
+            path (str): Path to downloaded file.
+
+        Returns:
+            str: Post shortcode or story item id, None if folder is not in ledger.
+        """
+        rows = self.execute('SELECT media_id FROM folders WHERE folder = ?',
+                            (os.path.basename(os.path.dirname(path)),))
+        return rows[0][0] if rows else None
+
+    def is_uploaded(self, path: str) -> bool:
+        """Check if downloaded file was already uploaded to VK.
+
+        Args:
+            path (str): Path to downloaded file.
+
+        Returns:
+            bool: True if file was uploaded, False otherwise.
+        """
+        return self.is_media_uploaded(self.media_id(path), os.path.basename(path))
+
+    def is_media_uploaded(self, media_id: str, file: str) -> bool:
+        """Check if file of post or story item was already uploaded to VK.
+
+        Args:
+            media_id (str): Post shortcode or story item id.
+            file (str): Name of file.
+
+        Returns:
+            bool: True if file was uploaded, False otherwise.
+        """
+        return bool(self.execute('SELECT 1 FROM uploads WHERE media_id = ? AND file = ?',
+                                 (media_id, file)))
+
+    def add_upload(self, path: str, vk_id: str) -> None:
+        """Storing id of VK photo or video which downloaded file was uploaded to.
+
+        Args:
+            path (str): Path to downloaded file.
+            vk_id (str): VK id in form photo{owner_id}_{id} or video{owner_id}_{id}.
+        """
+        media_id = self.media_id(path)
+        if media_id is not None:
+            self.add_media_upload(media_id, os.path.basename(path), vk_id)
+
+    def add_media_upload(self, media_id: str, file: str, vk_id: str) -> None:
+        """Storing id of VK photo or video which file of post or story item was uploaded to.
+
+        Args:
+            media_id (str): Post shortcode or story item id.
+            file (str): Name of file.
+            vk_id (str): VK id in form photo{owner_id}_{id} or video{owner_id}_{id}.
+        """
+        self.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)',
+                     (media_id, file, vk_id))
+
+    def add_jobs(self, paths: list, kind: str) -> None:
+        """Adding upload jobs of downloaded files to queue, files which are already queued keep their place.
+
+        Args:
+            paths (list): Paths to downloaded files.
+            kind (str): image or video.
+        """
+        for path in paths:
+            self.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?, 0, 0, ?, NULL)',
+                         (path, kind, 'pending'))
+
+    def pending_jobs(self, kind: str) -> dict:
+        """Get queued upload jobs in order they were added.
+
+        Args:
+            kind (str): image or video.
+
+        Returns:
+            dict: Tuples (order, attempts, next_attempt) by path, next_attempt is unix time.
+        """
+        rows = self.execute('SELECT path, rowid, attempts, next_attempt FROM jobs WHERE kind = ? AND state = ?',
+                            (kind, 'pending'))
+        return {path: (order, attempts, next_attempt) for path, order, attempts, next_attempt in rows}
+
+    def fail_job(self, path: str, error: str) -> bool:
+        """Storing failure of upload job and time of its next attempt,
+        job is marked dead after JOB_MAX_ATTEMPTS failures.
+
+        Args:
+            path (str): Path to downloaded file.
+            error (str): Error of failed attempt.
+
+        Returns:
+            bool: True if job is dead, False otherwise.
+        """
+        rows = self.execute('SELECT attempts FROM jobs WHERE path = ?', (path,))
+        if not rows:
+            return False
+        attempts = rows[0][0] + 1
+        delay = min(JOB_RETRY_BASE*2**(attempts - 1), JOB_RETRY_MAX)
+        state = 'dead' if attempts >= JOB_MAX_ATTEMPTS else 'pending'
+        self.execute('UPDATE jobs SET attempts = ?, next_attempt = ?, state = ?, error = ? WHERE path = ?',
+                     (attempts, time.time() + delay.total_seconds(), state, error, path))
+        return state == 'dead'
+
+    def bury_job(self, path: str, dead_path: str) -> None:
+        """Storing new path of dead job after its file was moved to dead-letter directory.
+
+        Args:
+            path (str): Path to downloaded file.
+            dead_path (str): Path to file in dead-letter directory.
+        """
+        self.execute('DELETE FROM jobs WHERE path = ?', (dead_path,))
+        self.execute('UPDATE jobs SET path = ? WHERE path = ?', (dead_path, path))
+
+    def finish_job(self, path: str) -> None:
+        """Removing job of uploaded file from queue.
+
+        Args:
+            path (str): Path to downloaded file.
+        """
+        self.execute('DELETE FROM jobs WHERE path = ?', (path,))
+
+    def dead_jobs(self) -> list:
+        """Get jobs which failed JOB_MAX_ATTEMPTS times.
+
+        Returns:
+            list: Tuples (path, error).
+        """
+        return self.execute('SELECT path, error FROM jobs WHERE state = ?', ('dead',))
+
+    def find_content(self, album: str, content_hash: str) -> str:
+        """Find VK photo or video with the same content which was uploaded to album before.
+
+        Args:
+            album (str): VK group and album ids in form {group}_{album}.
+            content_hash (str): Hash of file content.
+
+        Returns:
+            str: VK id of uploaded photo or video, None if there is no such.
+        """
+        rows = self.execute('SELECT vk_id FROM content WHERE content_hash = ? AND album = ?',
+                            (content_hash, album))
+        return rows[0][0] if rows else None
+
+    def find_similar(self, album: str, phash: str) -> str:
+        """Find VK photo which looks like image, for example the same image encoded again.
+        Similar images are only reported, as different images may have close perceptual hashes.
+        Hashes of low-detail images are not matched at all.
+
+        Args:
+            album (str): VK group and album ids in form {group}_{album}.
+            phash (str): Perceptual hash of image.
+
+        Returns:
+            str: VK id of uploaded photo, None if there is no such.
+        """
+        if phash is None or not PHASH_MIN_BITS <= bin(int(phash, 16)).count('1') <= 64 - PHASH_MIN_BITS:
+            return None
+        for stored_phash, vk_id in self.execute(
+                'SELECT phash, vk_id FROM content WHERE album = ? AND phash IS NOT NULL', (album,)):
+            if bin(int(stored_phash, 16) ^ int(phash, 16)).count('1') <= PHASH_DISTANCE:
+                return vk_id
+        return None
+
+    def find_content_anywhere(self, content_hash: str) -> str:
+        """Find VK photo or video with the same content which was uploaded to any album.
+
+        Args:
+            content_hash (str): Hash of file content.
+
+        Returns:
+            str: VK id of uploaded photo or video, None if there is no such.
+        """
+        rows = self.execute('SELECT vk_id FROM content WHERE content_hash = ? LIMIT 1',
+                            (content_hash,))
+        return rows[0][0] if rows else None
+
+    def add_content(self, album: str, content_hash: str, phash: str, vk_id: str) -> None:
+        """Storing VK photo or video uploaded to album with hashes of its content.
+
+        Args:
+            album (str): VK group and album ids in form {group}_{album}.
+            content_hash (str): Hash of file content.
+            phash (str): Perceptual hash of image, None for videos.
+            vk_id (str): VK id in form photo{owner_id}_{id} or video{owner_id}_{id}.
+        """
+        self.execute('INSERT OR REPLACE INTO content VALUES (?, ?, ?, ?)',
+                     (content_hash, album, phash, vk_id))
+
+
+class ProfileCursors():
+    def __init__(self,
+                 last_start_date: datetime,
+                 date_now: datetime,
+                 path: str = CURSORS_PATH,
+                 lookback: timedelta = NEW_PROFILE_LOOKBACK) -> None:
+        """Dates of newest downloaded post and story of every Instagram page.
+        Pages which are not in file yet start from lookback window before now.
+        If file does not exist yet, all pages start from last start date of module.
+
+        Args:
+            last_start_date (datetime): Last date of module start.
+            date_now (datetime): Current date of module start.
+            path (str, optional): Path to cursors file. Defaults to CURSORS_PATH.
+            lookback (timedelta, optional): Lookback window for new pages. Defaults to NEW_PROFILE_LOOKBACK.
+        """
+        self.path = path
+        self.lookback = lookback
+        self.lock = threading.Lock()
+        self.cursors = dict()
+
+        if os.path.exists(path):
+            self.default_date = date_now - lookback
+            with open(path) as file:
+                for username, kinds in json.load(file).items():
+                    self.cursors[username] = {
+                        kind: datetime.fromisoformat(date) for kind, date in kinds.items()}
+        else:
+            self.default_date = last_start_date
+
+    def new_cycle(self, date_now: datetime) -> None:
+        """Moving starting date of pages which are not in file yet to lookback window before date of new cycle,
+        so page added while daemon is running does not start from date of daemon start.
+        Until file is created pages keep starting from last start date of module.
+
+        Args:
+            date_now (datetime): Current date of cycle start.
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                self.default_date = date_now - self.lookback
+
+    def get(self, username: str, kind: str) -> datetime:
+        """Get date of newest downloaded post or story of page.
+
+        Args:
+            username (str): Instagram username.
+            kind (str): posts or stories.
+
+        Returns:
+            datetime: UTC date to download newer posts or stories from.
+        """
+        with self.lock:
+            return self.cursors.get(username, dict()).get(kind, self.default_date)
+
+    def advance(self, username: str, kind: str, date: datetime) -> None:
+        """Moving cursor of page forward after it is downloaded and storing all cursors to file.
+
+        Args:
+            username (str): Instagram username.
+            kind (str): posts or stories.
+            date (datetime): UTC date of newest downloaded post or story.
+        """
+        with self.lock:
+            kinds = self.cursors.setdefault(username, dict())
+            kinds[kind] = max(date, kinds.get(kind, self.default_date))
+            self.save()
+
+    def save(self) -> None:
+        """Storing cursors to file, replacing old file at once so it is never left half written.
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({username: {kind: date.isoformat() for kind, date in kinds.items()}
+                       for username, kinds in self.cursors.items()}, file)
+        os.replace(temp_path, self.path)
+
+
+class ProfileCache():
+    def __init__(self,
+                 context: instaloader.instaloadercontext.InstaloaderContext,
+                 path: str = PROFILE_CACHE_PATH,
+                 ttl: timedelta = PROFILE_CACHE_TTL,
+                 loader: Callable[[str], instaloader.Profile] = None) -> None:
+        """On disk cache of Instagram userids and profile metadata by username,
+        so stories can be fetched without resolving every profile again.
+        Entries older than ttl are resolved again.
+
+        Args:
+            context (instaloader.instaloadercontext.InstaloaderContext): Context of Instagram session.
+            path (str, optional): Path to cache file. Defaults to PROFILE_CACHE_PATH.
+            ttl (timedelta, optional): Time after which entry is resolved again. Defaults to PROFILE_CACHE_TTL.
+            loader (Callable[[str], instaloader.Profile], optional): Function loading profile by username.
+            Defaults to None, which means instaloader.Profile.from_username with provided context.
+        """
+        self.context = context
+        self.path = path
+        self.ttl = ttl
+        self.loader = loader if loader is not None else self.load
+        self.lock = threading.Lock()
+        self.profiles = dict()
+        self.new_run()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                self.profiles = json.load(file)
+
+    def new_run(self) -> None:
+        """Starting count of saved requests of new run, for example new cycle of daemon.
+        """
+        with self.lock:
+            self.saved_requests = 0
+            # Usernames resolved during this run, using them does not save any request
+            self.resolved = set()
+
+    def resolve(self, username: str) -> instaloader.Profile:
+        """Loading profile from Instagram and storing its metadata to cache.
+        If profile does not exist anymore, for example because it was renamed, its entry is removed.
+
+        Args:
+            username (str): Instagram username.
+
+        Returns:
+            instaloader.Profile: Loaded profile.
+        """
+        import instaloader
+
+        try:
+            profile = self.loader(username)
+        except instaloader.exceptions.ProfileNotExistsException:
+            self.invalidate(username)
+            raise
+
+        with self.lock:
+            self.profiles[username] = {
+                'userid': profile.userid,
+                'full_name': profile.full_name,
+                'fetched': datetime.utcnow().isoformat(),
+            }
+            self.resolved.add(username)
+            self.save()
+        return profile
+
+    def load(self, username: str) -> instaloader.Profile:
+        """Loading profile from Instagram with context of cache.
+
+        Args:
+            username (str): Instagram username.
+
+        Returns:
+            instaloader.Profile: Loaded profile.
+        """
+        import instaloader
+
+        return instaloader.Profile.from_username(self.context, username)
+
+    def userid(self, username: str) -> int:
+        """Get userid of profile from cache if entry is fresh, otherwise from Instagram.
+
+        Args:
+            username (str): Instagram username.
+
+        Returns:
+            int: Instagram userid.
+        """
+        with self.lock:
+            if self.is_fresh(username):
+                if username not in self.resolved:
+                    self.saved_requests += 1
+                return self.profiles[username]['userid']
+        return self.resolve(username).userid
+
+    def is_fresh(self, username: str) -> bool:
+        """Check if userid of profile is cached and its entry is not older than ttl,
+        so getting it does not cost any request.
+
+        Args:
+            username (str): Instagram username.
+
+        Returns:
+            bool: True if entry is fresh, False otherwise.
+        """
+        entry = self.profiles.get(username)
+        return entry is not None and datetime.utcnow() - datetime.fromisoformat(entry['fetched']) < self.ttl
+
+    def username(self, userid: int) -> str:
+        """Get cached username of profile with provided userid.
+
+        Args:
+            userid (int): Instagram userid.
+
+        Returns:
+            str: Cached username, None if userid is not in cache.
+        """
+        with self.lock:
+            for username, entry in self.profiles.items():
+                if entry['userid'] == userid:
+                    return username
+        return None
+
+    def invalidate(self, username: str) -> None:
+        """Removing entry of profile from cache.
+
+        Args:
+            username (str): Instagram username.
+        """
+        with self.lock:
+            if self.profiles.pop(username, None) is not None:
+                self.save()
+
+    def save(self) -> None:
+        """Storing cache to file, replacing old file at once so it is never left half written.
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.profiles, file)
+        os.replace(temp_path, self.path)
+
+
+class RequestBudget():
+    def __init__(self, path: str = BUDGET_PATH, hourly_budget: int = INST_HOURLY_BUDGET) -> None:
+        """Counting Instagram requests made through instaloader context across starts
+        and planning which pages to poll, so that freshness is maximal within hourly budget.
+        Pages which were updated are polled more often, quiet pages less often.
+
+        Args:
+            path (str, optional): Path to budget file. Defaults to BUDGET_PATH.
+            hourly_budget (int, optional): Maximum requests per hour. Defaults to INST_HOURLY_BUDGET.
+        """
+        self.path = path
+        self.hourly_budget = hourly_budget
+        self.lock = threading.Lock()
+        self.calls = list()
+        self.pages = dict()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                stored = json.load(file)
+            self.calls = stored['calls']
+            self.pages = stored['pages']
+
+    def install(self, context: instaloader.instaloadercontext.InstaloaderContext) -> None:
+        """Counting every request made through get_json of instaloader context.
+        Installing another budget to the same context replaces previous one.
+
+        Args:
+            context (instaloader.instaloadercontext.InstaloaderContext): Context of Instagram session.
+        """
+        if getattr(context, 'request_budget', None) is None:
+            get_json = context.get_json
+
+            def counted_get_json(*args, **kwargs):
+                context.request_budget.count()
+                with METRICS.request('instagram'):
+                    return get_json(*args, **kwargs)
+
+            context.get_json = counted_get_json
+        context.request_budget = self
+
+    def count(self) -> None:
+        """Storing time of single request.
+        """
+        with self.lock:
+            self.calls.append(time.time())
+
+    def used(self) -> int:
+        """Get number of requests made during last hour.
+
+        Returns:
+            int: Number of requests.
+        """
+        with self.lock:
+            hour_ago = time.time() - 3600
+            self.calls = [call for call in self.calls if call > hour_ago]
+            return len(self.calls)
+
+    def select(self, pages: list) -> list:
+        """Get pages which are due to be polled and fit into remaining budget,
+        most overdue pages first. Other pages are left for next starts.
+
+        Args:
+            pages (list): List of Instagram usernames.
+
+        Returns:
+            list: Usernames to be polled now.
+        """
+        remaining = self.hourly_budget - self.used()
+        now = datetime.utcnow()
+        overdue = list()
+        with self.lock:
+            for page in pages:
+                state = self.pages.get(page)
+                if state is None:
+                    overdue.append((math.inf, page))
+                    continue
+                waited = (now - datetime.fromisoformat(state['last_polled'])).total_seconds()
+                if waited >= state['interval']:
+                    overdue.append((waited/state['interval'], page))
+
+        selected = list()
+        for _, page in sorted(overdue, key=lambda x: x[0], reverse=True):
+            if remaining < PAGE_POLL_COST:
+                break
+            selected.append(page)
+            remaining -= PAGE_POLL_COST
+        print(f'Polling {len(selected)} of {len(pages)} pages, '
+              f'{self.used()} of {self.hourly_budget} Instagram requests used during last hour')
+        return selected
+
+    def record_poll(self, page: str, new_posts: int) -> None:
+        """Storing poll of page and changing its poll interval.
+        Interval is halved if page had new posts and grows otherwise.
+
+        Args:
+            page (str): Instagram username.
+            new_posts (int): Number of new posts found.
+        """
+        with self.lock:
+            state = self.pages.setdefault(
+                page, {'interval': POLL_INTERVAL_MIN.total_seconds()})
+            if new_posts:
+                interval = state['interval']/2
+            else:
+                interval = state['interval']*1.5
+            state['interval'] = min(max(interval, POLL_INTERVAL_MIN.total_seconds()),
+                                    POLL_INTERVAL_MAX.total_seconds())
+            state['last_polled'] = datetime.utcnow().isoformat()
+
+    def save(self) -> None:
+        """Storing request times and poll states to file, replacing old file at once.
+        """
+        self.used()
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump({'calls': self.calls, 'pages': self.pages}, file)
+            os.replace(temp_path, self.path)
+
+
+class LinkHealth():
+    def __init__(self, path: str = LINK_HEALTH_PATH, ttl: timedelta = LINK_HEALTH_TTL) -> None:
+        """On disk cache of link check results, so every start checks only links
+        which were not checked during ttl instead of all links at once.
+
+        Args:
+            path (str, optional): Path to cache file. Defaults to LINK_HEALTH_PATH.
+            ttl (timedelta, optional): Time after which link is checked again. Defaults to LINK_HEALTH_TTL.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results = dict()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                self.results = json.load(file)
+
+    def stale(self, keys: list) -> list:
+        """Get links which have no fresh result, never checked links first, then the oldest ones.
+
+        Args:
+            keys (list): Keys of links.
+
+        Returns:
+            list: Keys of links to be checked.
+        """
+        now = datetime.utcnow()
+        with self.lock:
+            checked = {key: self.results[key]['checked'] for key in keys if key in self.results}
+        stale = [key for key in keys if key not in checked or
+                 now - datetime.fromisoformat(checked[key]) >= self.ttl]
+        return sorted(stale, key=lambda key: checked.get(key, ''))
+
+    def store(self, key: str, ok: bool, error: str = None) -> None:
+        """Storing result of link check.
+
+        Args:
+            key (str): Key of link.
+            ok (bool): True if link is valid.
+            error (str, optional): Reason why link is not valid. Defaults to None.
+        """
+        with self.lock:
+            self.results[key] = {'ok': ok, 'error': error,
+                                 'checked': datetime.utcnow().isoformat()}
+
+    def broken(self, keys: list) -> list:
+        """Get links which were found not valid.
+
+        Args:
+            keys (list): Keys of links.
+
+        Returns:
+            list: Tuples (key, error).
+        """
+        with self.lock:
+            return [(key, self.results[key]['error']) for key in keys
+                    if key in self.results and not self.results[key]['ok']]
+
+    def save(self, keys: list) -> None:
+        """Storing results of provided links to file, results of links removed from links file are dropped.
+
+        Args:
+            keys (list): Keys of links.
+        """
+        with self.lock:
+            self.results = {key: result for key, result in self.results.items() if key in keys}
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.results, file)
+            os.replace(temp_path, self.path)
+
+
+class DataPreparer():
+    def __init__(self) -> None:
+        """Class to handle login to VK, Instagram,
+        storing and manipulating time of previous application start
+        and getting links of Instagram pages and VK groups.
+        """
+        self.vk_login = None
+        self.vk_pass = None
+        self.vk_session = None
+
+        self.inst_login = None
+        self.inst_pass = None
+        self.inst_session = None
+        self.profiles = None
+        self.budget = None
+
+        self.links = None
+        self.links_mtime = None
+        self.routes = None
+        self.broken_links = list()
+        self.link_health = LinkHealth()
+        self.ledger = MirrorLedger()
+
+        self.date_now = datetime.utcnow()
+        self.last_start_date = self.get_last_start_date()
+        self.cursors = ProfileCursors(self.last_start_date, self.date_now)
+        SpoolManifest.move_legacy_folders()
+
+        if self.vk_connection() & self.inst_connection() & self.load_links():
+            print('OK!')
+
+    def vk_connection(self) -> bool:
+        """Establishing connection to VK.
+
+        Returns:
+            bool: True if connection is OK, False otherwise.
+        """
+        self.get_credentials(CFG_PATH_VK, 'VK')
+
+        if self.vk_auth():
+            print('VK login ok!')
+            return True
+        print('VK login failed!')
+        return False
+
+    def get_credentials(self, path: str, mode: str) -> None:
+        """Getting credentials if they exists, otherwise
+        asking user to write them in console and then storing them to file.
+        If user provided broken credentials deleting file which holds credentials.
+
+        Args:
+            path (str): path to credentials, provided as module constant.
+            mode (str): type of credentials to work with: VK or INST.
+        """
+        if not os.path.exists(path) and not sys.stdin.isatty():
+            raise RuntimeError(
+                f'No {mode} credentials stored, start module from console once to enter them')
+        if os.path.exists(path):
+            with open(path) as file:
+                row = file.readline()
+                try:
+                    login, passw = base64.b64decode(
+                        row).decode('utf-8').split(',')
+                except ValueError:
+                    os.remove(path)
+        else:
+            login = input('Write login to '+mode+': ')
+            passw = input('Write pass to '+mode+': ')
+            with open(path, 'w') as file:
+                file.write(base64.b64encode(
+                    (login+','+passw).encode('utf-8')).decode('utf-8'))
+
+        if mode == 'VK':
+            self.vk_login = login
+            self.vk_pass = passw
+        else:
+            self.inst_login = login
+            self.inst_pass = passw
+
+    def captcha_handler(self, captcha):
+        """ При возникновении капчи вызывается эта функция и ей передается объект
+            капчи. Через метод get_url можно получить ссылку на изображение.
+            Через метод try_again можно попытаться отправить запрос с кодом капчи
+        """
+
+        key = input("Enter captcha code {0}: ".format(captcha.get_url())).strip()
+
+        # Пробуем снова отправить запрос с капчей
+        return captcha.try_again(key)
+
+    
+    def auth_handler(self):
+        code = input("Код для двухфакторной аутентификации: ")
+        return code, True
+
+
+    def vk_auth(self) -> bool:
+        """Authenticating to VK.
+
+        Returns:
+            bool: True if Auth is done correctly, False otherwise.
+        """
+        import vk_api
+
+        self.vk_session = vk_api.VkApi(self.vk_login, self.vk_pass, auth_handler = self.auth_handler, captcha_handler = self.captcha_handler)
+
+        try:
+            self.vk_session.auth()
+            AdaptiveRateLimiter().install(self.vk_session)
+            ExecuteBatcher().install(self.vk_session)
+            return True
+        except vk_api.exceptions.AuthError as e:
+            print(e)
+            os.remove(CFG_PATH_VK)
+            return False
+
+    def inst_connection(self) -> bool:
+        """Establishing connection to Instagram.
+
+        Returns:
+            bool: True if connection is OK, False otherwise.
+        """
+        self.get_credentials(CFG_PATH_INST, 'INST')
+
+        if self.inst_auth():
+            print('Instagram login ok!')
+            self.profiles = ProfileCache(self.inst_session.context)
+            self.budget = RequestBudget()
+            self.budget.install(self.inst_session.context)
+            return True
+        print('Instagram login failed!')
+        return False
+
+    def inst_auth(self) -> bool:
+        """Authenticating to Instagram.
+
+        Returns:
+            bool: True if Auth is done correctly, False otherwise.
+        """
+        import instaloader
+
+        self.inst_session = instaloader.Instaloader(
+            download_video_thumbnails=False,
+            download_geotags=False,
+            download_comments=False,
+            save_metadata=False,
+            request_timeout=3,
+            dirname_pattern=os.path.join(SPOOL_DIR, '{target}'),
+        )
+
+        if os.path.exists(INST_SESSION_PATH):
+            try:
+                self.inst_session.load_session_from_file(self.inst_login, filename=INST_SESSION_PATH)
+            except Exception:
+                os.remove(INST_SESSION_PATH)
+            return True
+        else:
+            try:
+                self.inst_session.login(self.inst_login, self.inst_pass)
+                self.inst_session.save_session_to_file(filename=INST_SESSION_PATH)
+                return True
+            except instaloader.exceptions.InstaloaderException:
+                os.remove(CFG_PATH_INST)
+                return False
+
+    def load_links(self) -> bool:
+        """Loading file with provided links to Instagram profiles and VK albums.
+        If there is no file, template with all columns is created.
+
+        Returns:
+            bool: True if file loaded correctly, False otherwise.
+        """
+        try:
+            self.links_mtime = os.path.getmtime(LINKS_PATH)
+            # Excel adds byte order mark to files saved as UTF-8
+            with open(LINKS_PATH, newline='', encoding='utf-8-sig') as file:
+                self.links = list(csv.DictReader(file, delimiter=';'))
+            self.routes = LinkIndex(self.links)
+            for row in self.routes.broken_rows:
+                print(f'Skipping {row}')
+            return True
+        except OSError:
+            with open(LINKS_PATH, 'w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file, delimiter=';')
+                writer.writerow(LINKS_COLUMNS)
+                for number in (1, 2):
+                    writer.writerow((f'https://www.instagram.com/PLACE_NAME_{number}/',
+                                     f'https://vk.com/album-PLACE_LINK_{number}',
+                                     f'https://vk.com/videos-PLACE_LINK_{number}?section=album_PLACE_LINK_{number}',
+                                     f'https://vk.com/album-PLACE_LINK_{number}',
+                                     f'https://vk.com/videos-PLACE_LINK_{number}?section=album_PLACE_LINK_{number}'))
+            print('Add your links to Links.csv!')
+            return False
+
+    def reload_links(self) -> None:
+        """Loading links file again if it was changed after previous loading.
+        """
+        if os.path.exists(LINKS_PATH) and os.path.getmtime(LINKS_PATH) != self.links_mtime:
+            print('Links.csv changed, reloading!')
+            self.load_links()
+
+    def checkpoint(self) -> None:
+        """Storing Instagram session and request budget, so next start continues from current state.
+        Downloaded media, cursors and profiles are stored as soon as they change.
+        """
+        if self.inst_session is not None:
+            self.inst_session.save_session_to_file(filename=INST_SESSION_PATH)
+        if self.budget is not None:
+            self.budget.save()
+
+    def check_links(self) -> bool:
+        """Checking provided links incrementally, so check is cheap enough to run on every start.
+        VK albums are checked by batches of VK_EXECUTE_LIMIT calls in single execute request,
+        Instagram profiles by single light request with cached userid, at most INST_LINK_CHECKS
+        profiles per start and only while less than half of hourly request budget is used.
+        Results are cached for LINK_HEALTH_TTL.
+
+        Returns:
+            bool: True if all checked links are valid, False otherwise.
+        """
+        import instaloader
+
+        if self.vk_session is None or self.inst_session is None or self.routes is None:
+            return False
+        links = self.link_targets()
+        stale = self.link_health.stale(list(links))
+
+        albums = [key for key in stale if not key.startswith('instagram:')]
+        pages = list()
+        if self.budget is None or self.budget.used() < self.budget.hourly_budget/2:
+            pages = [key for key in stale if key.startswith('instagram:')][:INST_LINK_CHECKS]
+        checks = [('vk', albums[number:number+VK_EXECUTE_LIMIT])
+                  for number in range(0, len(albums), VK_EXECUTE_LIMIT)]
+        checks += [('instagram', key) for key in pages]
+
+        def check(item: tuple) -> None:
+            host, target = item
+            if host == 'vk':
+                self.check_albums(target)
+            else:
+                self.check_profile(target)
+
+        # VK and Instagram are checked at once, each of them within its own limit
+        checks = AsyncWorker(checks, check, sum(LINK_CHECK_HOST_LIMITS.values()),
+                             host=lambda item: item[0], host_limits=LINK_CHECK_HOST_LIMITS,
+                             timeout=LINK_CHECK_TIMEOUT,
+                             stop_on=(instaloader.exceptions.TooManyRequestsException,))
+        for result in checks.results:
+            if result.error is None:
+                continue
+            if result.item[0] == 'vk':
+                print(f'VK albums check failed, trying again next start: {result.error}')
+            else:
+                print(f'Instagram profile check failed, trying again next start: {result.error!r}')
+
+        self.link_health.save(list(links))
+        self.broken_links = [f'{links[key]} {error}' for key, error in self.link_health.broken(list(links))]
+        if self.broken_links != list():
+            print('Change these links:')
+            for url in self.broken_links:
+                print(url)
+            return False
+        print(f'Links ok! Checked {len(albums)} VK albums and {len(pages)} Instagram profiles')
+        return True
+
+    def check_links_in_background(self) -> threading.Thread:
+        """Starting check of links in background thread while sync cycle is running.
+
+        Returns:
+            threading.Thread: Started thread to be joined.
+        """
+        thread = threading.Thread(target=self.check_links, daemon=True)
+        thread.start()
+        return thread
+
+    def link_targets(self) -> dict:
+        """Get every Instagram profile and VK album of links file.
+
+        Returns:
+            dict: Links by key, keys are instagram:{username}, photo:{group}_{album} and video:{group}_{album}.
+        """
+        links = dict()
+        for username in self.routes.usernames:
+            links[f'instagram:{username}'] = f'https://www.instagram.com/{username}/'
+            for is_post in (True, False):
+                route = self.routes.get(username, is_post)
+                links[f'photo:{route.image_group}_{route.image_album}'] = (
+                    f'https://vk.com/album-{route.image_group}_{route.image_album}')
+                if route.video_group is not None:
+                    links[f'video:{route.video_group}_{route.video_album}'] = (
+                        f'https://vk.com/videos-{route.video_group}?section=album_{route.video_album}')
+        return links
+
+    def check_albums(self, keys: list) -> None:
+        """Checking several VK albums with single execute request.
+        Call of missing or not accessible album returns false inside execute.
+
+        Args:
+            keys (list): Keys of albums, up to VK_EXECUTE_LIMIT.
+        """
+        calls = list()
+        for key in keys:
+            kind, ids = key.split(':')
+            group, album = ids.split('_')
+            if kind == 'photo':
+                calls.append('API.photos.getAlbums({})'.format(
+                    json.dumps({'owner_id': -int(group), 'album_ids': album})))
+            else:
+                calls.append('API.video.getAlbumById({})'.format(
+                    json.dumps({'owner_id': -int(group), 'album_id': int(album)})))
+        results = self.vk_session.method('execute', {'code': f'return [{",".join(calls)}];'})
+
+        for key, result in zip(keys, results):
+            album = key.split('_')[-1]
+            ok = bool(result)
+            if ok and key.startswith('photo:'):
+                ok = any(str(item['id']) == album for item in result['items'])
+            self.link_health.store(key, ok, None if ok else 'album does not exist or is not accessible')
+
+    def check_profile(self, key: str) -> None:
+        """Checking Instagram profile by light request of its user info by cached userid,
+        which also finds out if profile was renamed.
+
+        Args:
+            key (str): Key of profile.
+        """
+        import instaloader
+
+        username = key.split(':', 1)[1]
+        try:
+            userid = self.profiles.userid(username)
+            # Endpoint of mobile API, get_iphone_json sends request to i.instagram.com with iPhone headers
+            # through get_json, so request is still counted by budget
+            user = self.inst_session.context.get_iphone_json(f'api/v1/users/{userid}/info/', params={}).get('user')
+        except (instaloader.exceptions.ProfileNotExistsException,
+                instaloader.exceptions.QueryReturnedNotFoundException):
+            user = None
+
+        if not user:
+            self.link_health.store(key, False, 'profile does not exist or blocked you')
+        elif user.get('username') != username:
+            self.profiles.invalidate(username)
+            self.link_health.store(key, False, f'profile was renamed to {user.get("username")}')
+        else:
+            self.link_health.store(key, True)
+
+    def get_last_start_date(self) -> datetime:
+        """Getting last start date of module if file exists,
+        otherwise creating file and writing time.
+
+        Returns:
+            datetime: UTC time of last module start if ISO format.
+        """
+        if os.path.exists(LAST_START_PATH):
+            with open(LAST_START_PATH) as file:
+                last_start_date = datetime.fromisoformat(file.read())
+                return last_start_date
+        else:
+            with open(LAST_START_PATH, 'w') as file:
+                file.write(str(self.date_now.isoformat()))
+                return self.date_now
+
+
+class ChunkedVideoUploader():
+    def __init__(self,
+                 vk_session: vk_api.vk_api.VkApi,
+                 http: requests.Session,
+                 path: str = VIDEO_PROGRESS_PATH,
+                 chunk_size: int = VIDEO_CHUNK_SIZE,
+                 bandwidth: int = VIDEO_BANDWIDTH) -> None:
+        """Resumable upload of videos to VK upload server by chunks.
+        Upload session of every video is stored after each confirmed chunk,
+        so interrupted upload continues from last confirmed chunk on next start.
+
+        Args:
+            vk_session (vk_api.vk_api.VkApi): Session with access to provided VK group folders.
+            http (requests.Session): HTTP session to send chunks with.
+            path (str, optional): Path to progress file. Defaults to VIDEO_PROGRESS_PATH.
+            chunk_size (int, optional): Size of chunk in bytes. Defaults to VIDEO_CHUNK_SIZE.
+            bandwidth (int, optional): Bytes per second shared by all uploads, None means no cap.
+            Defaults to VIDEO_BANDWIDTH.
+        """
+        self.vk_session = vk_session
+        self.http = http
+        self.path = path
+        self.chunk_size = chunk_size
+        self.bandwidth = None
+        if bandwidth:
+            self.bandwidth = TokenBucket(bandwidth, capacity=max(bandwidth, chunk_size))
+        self.lock = threading.Lock()
+        self.progress = dict()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                self.progress = json.load(file)
+
+    def upload(self,
+               video_file: str,
+               name: str,
+               description: str,
+               group_id: str,
+               album_id: str,
+               stream: BinaryIO = None) -> dict:
+        """Uploading video, continuing stored upload session if there is one.
+
+        Args:
+            video_file (str): Path to video.
+            name (str): Name of video.
+            description (str): Description of video.
+            group_id (str): VK group id.
+            album_id (str): VK album id.
+            stream (BinaryIO, optional): Seekable file object with video, if provided
+            video_file is used only as name of upload session. Defaults to None.
+
+        Returns:
+            dict: Owner id and video id of uploaded video.
+        """
+        if stream is None:
+            with open(video_file, 'rb') as file:
+                return self.upload(video_file, name, description, group_id, album_id, file)
+
+        with self.lock:
+            state = self.progress.get(video_file)
+        if state is None:
+            values = {'name': name, 'description': description,
+                      'group_id': group_id, 'album_id': album_id}
+            response = self.vk_session.method(
+                'video.save', {key: value for key, value in values.items() if value is not None})
+            state = {'upload_url': response['upload_url'],
+                     'owner_id': response['owner_id'],
+                     'video_id': response['video_id'],
+                     'session_id': uuid.uuid4().hex,
+                     'offset': 0}
+            self.store(video_file, state)
+        elif state['offset']:
+            print(f'{video_file} continuing upload from {state["offset"]} bytes')
+
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(state['offset'])
+        while state['offset'] < size:
+            chunk = stream.read(self.chunk_size)
+            if self.bandwidth is not None:
+                self.bandwidth.acquire(len(chunk))
+            self.send_chunk(video_file, state, chunk, size)
+            state['offset'] += len(chunk)
+            self.store(video_file, state)
+
+        self.store(video_file, None)
+        return {'owner_id': state['owner_id'], 'video_id': state['video_id']}
+
+    def send_chunk(self, video_file: str, state: dict, chunk: bytes, size: int) -> None:
+        """Sending single chunk to upload server.
+        If server lost upload session, stored session is removed and upload starts from zero next time.
+
+        Args:
+            video_file (str): Path to video.
+            state (dict): Upload session of video.
+            chunk (bytes): Chunk to be sent.
+            size (int): Size of whole video in bytes.
+        """
+        end = state['offset'] + len(chunk) - 1
+        with METRICS.request('vk_video_chunk'):
+            response = self.http.post(
+                state['upload_url'],
+                data=chunk,
+                headers={
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Disposition': f'attachment; filename="{os.path.basename(video_file)}"',
+                    'Content-Range': f'bytes {state["offset"]}-{end}/{size}',
+                    'Session-ID': state['session_id'],
+                },
+            )
+        if response.status_code in (400, 404, 410):
+            self.store(video_file, None)
+        response.raise_for_status()
+        METRICS.count('vk_upload_bytes', len(chunk))
+
+    def store(self, video_file: str, state: dict) -> None:
+        """Storing upload session of video to file, None removes it.
+
+        Args:
+            video_file (str): Path to video.
+            state (dict): Upload session of video.
+        """
+        with self.lock:
+            if state is None:
+                self.progress.pop(video_file, None)
+            else:
+                self.progress[video_file] = dict(state)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.progress, file)
+            os.replace(temp_path, self.path)
+
+
+class StreamingMirror():
+    def __init__(self,
+                 instagram_session: instaloader.instaloader.Instaloader,
+                 vk_session: vk_api.vk_api.VkApi,
+                 routes: LinkIndex,
+                 ledger: MirrorLedger,
+                 spool_threshold: int = STREAM_SPOOL_THRESHOLD) -> None:
+        """Class to upload media of posts and stories from Instagram CDN to VK without storing files on disk.
+        Every file is read into its own in-memory buffer, only files larger than spool_threshold
+        are spooled to temporary file.
+
+        Args:
+            instagram_session (instaloader.instaloader.Instaloader): Instagram session to read media with.
+            vk_session (vk_api.vk_api.VkApi): Session with access to provided VK group folders.
+            routes (LinkIndex): Index of provided links to Instagram pages and VK albums.
+            ledger (MirrorLedger): Ledger of already uploaded media.
+            spool_threshold (int, optional): Maximum size of in-memory buffer in bytes. Defaults to STREAM_SPOOL_THRESHOLD.
+        """
+        import requests
+
+        self.context = instagram_session.context
+        self.vk_session = vk_session
+        self.routes = routes
+        self.ledger = ledger
+        self.spool_threshold = spool_threshold
+        self.http = requests.Session()
+        self.http.mount('https://', requests.adapters.HTTPAdapter(
+            pool_maxsize=UPLOAD_WORKERS))
+        self.video_upload = ChunkedVideoUploader(self.vk_session, self.http)
+
+    def mirror_post(self, post: instaloader.Post, username: str) -> bool:
+        """Uploading all images and videos of post to VK albums of page.
+
+        Args:
+            post (instaloader.Post): Instagram post.
+            username (str): Instagram username.
+
+        Returns:
+            bool: True if all files of post are uploaded, False otherwise.
+        """
+        if post.typename == 'GraphSidecar':
+            nodes = [(node.is_video, node.video_url if node.is_video else node.display_url)
+                     for node in post.get_sidecar_nodes()]
+        else:
+            nodes = [(post.is_video, post.video_url if post.is_video else post.url)]
+        media = [(f'{number}.mp4' if is_video else f'{number}.jpg', url)
+                 for number, (is_video, url) in enumerate(nodes, start=1)]
+        uploaded = self.mirror(post.shortcode, media, username, True,
+                               post.caption, f'{post.date:%y%m%d} Instagram @{username}')
+        if uploaded:
+            self.ledger.add_download(post.shortcode, 'posts')
+        return uploaded
+
+    def mirror_storyitem(self, item: instaloader.StoryItem, username: str) -> bool:
+        """Uploading image or video of story item to VK albums of page.
+
+        Args:
+            item (instaloader.StoryItem): Instagram story item.
+            username (str): Instagram username.
+
+        Returns:
+            bool: True if story item is uploaded, False otherwise.
+        """
+        media = [('1.mp4', item.video_url) if item.is_video else ('1.jpg', item.url)]
+        uploaded = self.mirror(str(item.mediaid), media, username, False,
+                               None, f'{item.date:%y%m%d} Instagram stories')
+        if uploaded:
+            self.ledger.add_download(str(item.mediaid), 'stories')
+        return uploaded
+
+    def mirror(self, media_id: str, media: list, username: str, is_post: bool, description: str, video_name: str) -> bool:
+        """Uploading files of single post or story item which are not uploaded yet.
+        Images are uploaded with single request, videos one by one.
+
+        Args:
+            media_id (str): Post shortcode or story item id.
+            media (list): List of tuples (file name, media url).
+            username (str): Instagram username.
+            is_post (bool): True if uploading post, False if uploading story.
+            description (str): Description of post.
+            video_name (str): Name of videos in VK.
+
+        Returns:
+            bool: True if all files are uploaded, False otherwise.
+        """
+        import instaloader
+        import requests
+        import vk_api
+
+        route = self.routes.get(username, is_post)
+        desc = None
+        if description is not None:
+            desc = description.replace('@', '@ ')
+
+        pending = [(file, url) for file, url in media
+                   if not self.ledger.is_media_uploaded(media_id, file)]
+        images = [(file, url) for file, url in pending if file.endswith('.jpg')]
+        videos = [(file, url) for file, url in pending
+                  if file.endswith('.mp4') and route.video_group is not None]
+        try:
+            for number in range(0, len(images), VK_PHOTOS_PER_UPLOAD):
+                self.photo_uploader(
+                    media_id, images[number:number+VK_PHOTOS_PER_UPLOAD], desc, route)
+            for file, url in videos:
+                with self.fetch(url) as stream:
+                    video = self.video_upload.upload(f'{media_id}_{file}', video_name, desc,
+                                                     route.video_group, route.video_album, stream)
+                vk_id = 'video{}_{}'.format(video['owner_id'], video['video_id'])
+                self.ledger.add_media_upload(media_id, file, vk_id)
+                print('\n'+f'{username} Vk upload done to https://vk.com/{vk_id}'+'\n')
+        except (instaloader.exceptions.InstaloaderException, vk_api.exceptions.VkApiError,
+                requests.exceptions.RequestException, OSError) as e:
+            print(f'{username} {media_id} Vk upload failed: {e}')
+            return False
+        return True
+
+    def photo_uploader(self, media_id: str, images: list, description: str, route: VKRoute) -> None:
+        """Uploading several images to VK album with single request.
+
+        Args:
+            media_id (str): Post shortcode or story item id.
+            images (list): List of tuples (file name, media url).
+            description (str): Description of images.
+            route (VKRoute): VK album ids of page.
+        """
+        streams = [self.fetch(url) for _, url in images]
+        try:
+            server = self.vk_session.method('photos.getUploadServer', {
+                'album_id': route.image_album, 'group_id': route.image_group})
+            files = {f'file{number}': (file, stream) for number, ((file, _), stream)
+                     in enumerate(zip(images, streams), start=1)}
+            with METRICS.request('vk_photo_upload'):
+                response = self.http.post(server['upload_url'], files=files)
+            response.raise_for_status()
+            METRICS.count('vk_upload_bytes', sum(
+                stream.seek(0, os.SEEK_END) for stream in streams))
+            uploaded = response.json()
+        finally:
+            for stream in streams:
+                stream.close()
+
+        values = {'album_id': route.image_album, 'group_id': route.image_group,
+                  'server': uploaded['server'], 'photos_list': uploaded['photos_list'],
+                  'hash': uploaded['hash'], 'caption': description}
+        photos = self.vk_session.method(
+            'photos.save', {key: value for key, value in values.items() if value is not None})
+        for (file, _), photo in zip(images, photos):
+            vk_id = 'photo{}_{}'.format(photo['owner_id'], photo['id'])
+            self.ledger.add_media_upload(media_id, file, vk_id)
+            print('\n'+f'{media_id} Vk upload done to https://vk.com/{vk_id}'+'\n')
+
+    def fetch(self, url: str) -> BinaryIO:
+        """Reading media from Instagram CDN into buffer which is spooled to disk only if it grows above threshold.
+
+        Args:
+            url (str): Media url.
+
+        Returns:
+            BinaryIO: Buffer with media, positioned at start.
+        """
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold)
+        try:
+            response = self.context.get_raw(url)
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                buffer.write(chunk)
+                METRICS.count('instagram_download_bytes', len(chunk))
+        except BaseException:
+            buffer.close()
+            raise
+        buffer.seek(0)
+        return buffer
+
+
+class SpoolFolder(NamedTuple):
+    """Folder with downloaded post or story."""
+    name: str
+    counter: int
+    is_post: bool
+    username: str
+    media: list
+    description: str
+
+
+class SpoolManifest():
+    def __init__(self, folders: list = None, spool_dir: str = SPOOL_DIR) -> None:
+        """Manifest of folders downloaded into spool directory with their media files,
+        descriptions and counters. It is built by single os.scandir pass and shared by
+        InstagramDownloader, DataCollector and VKUploader instead of listing folders again.
+
+        Args:
+            folders (list, optional): Names of folders to be scanned. Defaults to None, which means all folders.
+            spool_dir (str, optional): Directory with downloaded folders. Defaults to SPOOL_DIR.
+        """
+        self.spool_dir = spool_dir
+        self.lock = threading.Lock()
+        self.folders = dict()
+
+        os.makedirs(spool_dir, exist_ok=True)
+        if folders is None:
+            with os.scandir(spool_dir) as entries:
+                folders = [entry.name for entry in entries
+                           if '：' in entry.name and entry.is_dir()]
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder: str) -> None:
+        """Scanning single folder and adding it to manifest.
+
+        Args:
+            folder (str): Folder name.
+        """
+        try:
+            counter, rest = folder.split('_', 1)
+            kind, username = rest.split('：', 1)
+            counter = int(counter)
+        except ValueError:
+            print(f'{folder} is not created by this module, skipping')
+            return
+
+        media = list()
+        description = None
+        try:
+            with os.scandir(self.path(folder)) as entries:
+                for entry in entries:
+                    if entry.name.endswith(('.jpg', '.mp4')):
+                        media.append(entry.name)
+                    elif entry.name.endswith('.txt'):
+                        with open(entry.path, encoding='UTF-8') as file:
+                            description = file.read()
+        except FileNotFoundError:
+            # Folder was uploaded and removed after it was listed
+            return
+
+        with self.lock:
+            self.folders[folder] = SpoolFolder(
+                folder, counter, kind == 'posts', username, sorted(media), description)
+
+    def path(self, folder: str, file: str = None) -> str:
+        """Get path to folder or to file in it.
+
+        Args:
+            folder (str): Folder name.
+            file (str, optional): File name. Defaults to None.
+
+        Returns:
+            str: Path to folder or file.
+        """
+        if file is None:
+            return os.path.join(self.spool_dir, folder)
+        return os.path.join(self.spool_dir, folder, file)
+
+    def sorted(self) -> list:
+        """Get folders in order of their counters.
+
+        Returns:
+            list: List of SpoolFolder.
+        """
+        with self.lock:
+            return sorted(self.folders.values(), key=lambda x: x.counter)
+
+    @property
+    def last_counter(self) -> int:
+        """Biggest counter of folders, 0 if there are no folders."""
+        with self.lock:
+            return max((folder.counter for folder in self.folders.values()), default=0)
+
+    def discard(self, path: str) -> None:
+        """Removing file from media of its folder after it was deleted.
+
+        Args:
+            path (str): Path to file.
+        """
+        folder = os.path.basename(os.path.dirname(path))
+        with self.lock:
+            if folder in self.folders and os.path.basename(path) in self.folders[folder].media:
+                self.folders[folder].media.remove(os.path.basename(path))
+
+    def forget(self, folders: list) -> None:
+        """Removing folders from manifest after they were handled elsewhere.
+
+        Args:
+            folders (list): Folder names.
+        """
+        with self.lock:
+            for folder in folders:
+                self.folders.pop(folder, None)
+
+    @staticmethod
+    def move_legacy_folders(spool_dir: str = SPOOL_DIR) -> None:
+        """Moving folders downloaded into working directory by previous versions to spool directory.
+
+        Args:
+            spool_dir (str, optional): Directory with downloaded folders. Defaults to SPOOL_DIR.
+        """
+        os.makedirs(spool_dir, exist_ok=True)
+        with os.scandir() as entries:
+            for entry in entries:
+                if '：' in entry.name and entry.is_dir():
+                    shutil.move(entry.path, os.path.join(spool_dir, entry.name))
+
+
+class InstagramDownloader:
+    def __init__(self,
+                 instagram_session: instaloader.instaloader.Instaloader,
+                 routes: LinkIndex,
+                 cursors: ProfileCursors,
+                 date_now: datetime,
+                 num_workers: int = DOWNLOAD_WORKERS,
+                 on_folder: Callable[[str], None] = None,
+                 on_stories_chunk: Callable[[list], None] = None,
+                 ledger: MirrorLedger = None,
+                 profiles: ProfileCache = None,
+                 budget: RequestBudget = None,
+                 streamer: StreamingMirror = None,
+                 manifest: SpoolManifest = None) -> None:
+        """Class to download new posts and stories from provided page links
+        which are newer than cursor of their page.
+
+        Args:
+            instagram_session (instaloader.instaloader.Instaloader): Instagram session which will be used to download stories.
+            routes (LinkIndex): Index of provided links to Instagram pages and VK albums.
+            cursors (ProfileCursors): Dates of newest downloaded post and story of every page.
+            date_now (datetime): Current date of module start.
+            num_workers (int, optional): Number of profiles downloaded at once. Defaults to DOWNLOAD_WORKERS.
+            on_folder (Callable[[str], None], optional): Function called with name of every
+            folder after its downloading is finished. Defaults to None.
+            on_stories_chunk (Callable[[list], None], optional): Function called with names of folders
+            downloaded from stories of every STORY_CHUNK_SIZE profiles before next profiles are requested. Defaults to None.
+            ledger (MirrorLedger, optional): Ledger of already downloaded media. Defaults to None,
+            which means ledger stored in LEDGER_PATH.
+            profiles (ProfileCache, optional): Cache of profile userids. Defaults to None,
+            which means cache stored in PROFILE_CACHE_PATH.
+            budget (RequestBudget, optional): Instagram request budget. Defaults to None,
+            which means budget stored in BUDGET_PATH.
+            streamer (StreamingMirror, optional): If provided, media is uploaded to VK by it
+            instead of being downloaded to disk. Defaults to None.
+            manifest (SpoolManifest, optional): Manifest of downloaded folders, new folders are added to it.
+            Defaults to None, which means all folders in SPOOL_DIR.
+        """
+        self.inst_session = instagram_session
+        self.routes = routes
+        self.cursors = cursors
+        self.date_now = date_now
+        self.num_workers = num_workers
+        self.on_folder = on_folder
+        self.on_stories_chunk = on_stories_chunk
+        self.streamer = streamer
+        self.manifest = manifest if manifest is not None else SpoolManifest()
+        self.ledger = ledger if ledger is not None else MirrorLedger()
+        self.profiles = profiles if profiles is not None else ProfileCache(
+            self.inst_session.context)
+        self.budget = budget if budget is not None else RequestBudget()
+        self.budget.install(self.inst_session.context)
+        self.rate_limit = TokenBucket(INST_REQUESTS_PER_SECOND)
+        self.install_rate_limit(self.inst_session.context)
+
+        self.timings = dict()
+        self.pages = self.get_pages()
+
+        # Not overriding folders which were not uploaded to VK yet
+        self.folder_counter = self.manifest.last_counter + 1
+        try:
+            self.download_posts()
+            self.download_stories()
+        finally:
+            self.budget.save()
+        self.update_last_start_date()
+
+    def install_rate_limit(self, context: instaloader.instaloadercontext.InstaloaderContext) -> None:
+        """Pacing every request made through get_json of instaloader context by rate limit of downloader,
+        including pages of posts requested while iterating them and requests of stories.
+        Installing rate limit of another downloader to the same context replaces previous one.
+
+        Args:
+            context (instaloader.instaloadercontext.InstaloaderContext): Context of Instagram session.
+        """
+        if getattr(context, 'rate_limit', None) is None:
+            get_json = context.get_json
+
+            def paced_get_json(*args, **kwargs):
+                METRICS.count('instagram_rate_limit_wait_seconds', context.rate_limit.acquire())
+                return get_json(*args, **kwargs)
+
+            context.get_json = paced_get_json
+        context.rate_limit = self.rate_limit
+
+    def get_pages(self) -> list:
+        """Get usenames from provided instagram pages.
+
+        Returns:
+            list: List of instagram usernames.
+        """
+        return list(self.routes.usernames)
+
+    @METRICS.stage('download_posts')
+    def download_posts(self) -> None:
+        """Download new Instagram posts of several profiles at once.
+        Every profile gets its own range of folder counters, so folders stay in order.
+        """
+        print('Getting posts!')
+        start = time.perf_counter()
+        pages = self.budget.select(self.pages)
+        counters = [self.folder_counter + FOLDER_COUNTER_RANGE*i
+                    for i in range(len(pages))]
+        downloads = AsyncWorker(zip(pages, counters), lambda page: self.download_page(*page),
+                                self.num_workers)
+        if downloads.errors:
+            raise downloads.errors[0]
+        self.folder_counter += FOLDER_COUNTER_RANGE*len(pages)
+        self.report_timings(time.perf_counter() - start)
+
+    def download_page(self, page: str, folder_counter: int) -> None:
+        """Download new posts of single Instagram profile.
+
+        Args:
+            page (str): Instagram username.
+            folder_counter (int): First folder counter of range given to this profile.
+        """
+        import instaloader
+
+        start = time.perf_counter()
+        new_posts = 0
+        try:
+            profile = self.profiles.resolve(page)
+            print(page)
+            last_date = newest_date = self.cursors.get(page, 'posts')
+            completed = True
+            for post in profile.get_posts():
+                if last_date < post.date:
+                    newest_date = max(newest_date, post.date)
+                    if self.ledger.is_downloaded(post.shortcode):
+                        continue
+                    new_posts += 1
+                    if self.streamer is not None:
+                        # Failed posts are tried again next time as cursor is not moved
+                        completed &= self.streamer.mirror_post(post, page)
+                        continue
+                    folder = self.folder_name(folder_counter, 'posts', page)
+                    self.inst_session.download_post(post, folder)
+                    self.ledger.add_download(post.shortcode, 'posts', folder)
+                    self.folder_done(folder)
+                    folder_counter += 1
+                else:
+                    break
+            if completed:
+                self.cursors.advance(page, 'posts', newest_date)
+        except instaloader.exceptions.InstaloaderException as e:
+            print(f'{page} download failed: {e}')
+        finally:
+            self.budget.record_poll(page, new_posts)
+            self.timings[page] = time.perf_counter() - start
+
+    def report_timings(self, wall_time: float) -> None:
+        """Printing time spent on every profile and speedup compared to downloading them one by one.
+
+        Args:
+            wall_time (float): Time in seconds spent on downloading all profiles.
+        """
+        serial_time = sum(self.timings.values())
+        for page, seconds in sorted(self.timings.items(), key=lambda x: x[1], reverse=True):
+            print(f'{page}: {seconds:.1f}s')
+        speedup = serial_time/wall_time if wall_time else 1.0
+        print(f'Posts downloaded in {wall_time:.1f}s, '
+              f'profiles took {serial_time:.1f}s in total, speedup x{speedup:.1f}')
+
+    @METRICS.stage('download_stories')
+    def download_stories(self) -> None:
+        """Download new Instagram stories by chunks of STORY_CHUNK_SIZE profiles,
+        so stories of single chunk are processed and released before next chunk is requested.
+        """
+        import instaloader
+
+        print('Getting stories!')
+        profile_ids = list()
+        # Pages without fresh cached userid cost a request each, only as many of them as fit into budget
+        # are resolved, so first start with many pages does not go over hourly budget.
+        # Requests of stories by chunks of profiles are reserved too
+        remaining = (self.budget.hourly_budget - self.budget.used()
+                     - math.ceil(len(self.pages)/STORY_CHUNK_SIZE))
+        postponed = 0
+        for page in self.pages:
+            if not self.profiles.is_fresh(page):
+                if remaining <= 0:
+                    postponed += 1
+                    continue
+                remaining -= 1
+            try:
+                profile_ids.append(self.profiles.userid(page))
+            except instaloader.exceptions.InstaloaderException as e:
+                print(f'{page} userid not found: {e}')
+        print(f'Profile cache saved {self.profiles.saved_requests} Instagram requests')
+        if postponed:
+            print(f'Stories of {postponed} pages are left for next starts to keep within hourly request budget')
+
+        for number in range(0, len(profile_ids), STORY_CHUNK_SIZE):
+            folders = self.download_stories_chunk(profile_ids[number:number+STORY_CHUNK_SIZE])
+            if folders and self.on_stories_chunk is not None:
+                self.on_stories_chunk(folders)
+
+    def download_stories_chunk(self, profile_ids: list) -> list:
+        """Download new stories of several profiles. Failed profile is tried again next time
+        as its cursor is not moved, it does not stop other profiles.
+
+        Args:
+            profile_ids (list): Instagram userids.
+
+        Returns:
+            list: Names of downloaded folders.
+        """
+        import instaloader
+
+        folders = list()
+        try:
+            for story in self.inst_session.get_stories(profile_ids):
+                username = story.owner_profile.username
+                try:
+                    self.download_story(story, folders)
+                except instaloader.exceptions.InstaloaderException as e:
+                    print(f'{username} stories download failed: {e}')
+        except instaloader.exceptions.InstaloaderException as e:
+            print(f'Stories of {len(profile_ids)} profiles download failed: {e}')
+        return folders
+
+    def download_story(self, story: instaloader.Story, folders: list) -> None:
+        """Download new items of story of single profile.
+
+        Args:
+            story (instaloader.Story): Story of profile.
+            folders (list): List to add names of downloaded folders to.
+        """
+        username = story.owner_profile.username
+        cached_username = self.profiles.username(story.owner_id)
+        if cached_username is not None and cached_username != username:
+            print(f'{cached_username} was renamed to {username}, change Links.csv')
+            self.profiles.invalidate(cached_username)
+        if username not in self.routes:
+            print(f'{username} is not in Links.csv, skipping stories')
+            return
+        video_required = self.routes.get(
+            username, False).video_group is not None
+        print(username)
+        last_date = newest_date = self.cursors.get(username, 'stories')
+        completed = True
+        for item in story.get_items():
+            # Bound by date of newest story downloaded before
+            if last_date < item.date:
+                newest_date = max(newest_date, item.date)
+                # Not downloading video from instagram pages without VK story video link
+                if (video_required or not item.is_video) and not self.ledger.is_downloaded(str(item.mediaid)):
+                    if self.streamer is not None:
+                        completed &= self.streamer.mirror_storyitem(
+                            item, username)
+                        continue
+                    folder = self.folder_name(
+                        self.folder_counter, 'stories', username)
+                    self.inst_session.download_storyitem(item, folder)
+                    self.ledger.add_download(
+                        str(item.mediaid), 'stories', folder)
+                    self.folder_done(folder)
+                    folders.append(folder)
+                    self.folder_counter += 1
+            else:
+                break
+        if completed:
+            self.cursors.advance(username, 'stories', newest_date)
+
+    def folder_done(self, folder: str) -> None:
+        """Adding downloaded folder to manifest and passing its name to provided on_folder function.
+
+        Args:
+            folder (str): Name of downloaded folder.
+        """
+        self.manifest.add(folder)
+        if folder in self.manifest.folders:
+            METRICS.count('instagram_download_bytes', sum(
+                os.path.getsize(self.manifest.path(folder, file)) for file in self.manifest.folders[folder].media))
+        if self.on_folder is not None:
+            self.on_folder(folder)
+
+    @staticmethod
+    def folder_name(folder_counter: int, kind: str, username: str) -> str:
+        """Get name of folder to download post or story into.
+
+        Args:
+            folder_counter (int): Number of folder to keep folders in order.
+            kind (str): posts or stories.
+            username (str): Instagram username.
+
+        Returns:
+            str: Folder name in the same form as it is stored on disk.
+        """
+        return f'{folder_counter}_{kind}：{username}'
+
+    def update_last_start_date(self) -> None:
+        """Updating time of module last start date after finishing downloading new posts and stories.
+        Used only as starting cursor of pages if cursors file is lost.
+        """
+        with open(LAST_START_PATH, 'w') as file:
+            file.write(str(self.date_now.isoformat()))
+
+
+class DataCollector:
+    def __init__(self, routes: LinkIndex, manifest: SpoolManifest = None) -> None:
+        """Collecting all downladed files and sorting them by type
+        to feed into VKUploader class.
+
+        Args:
+            routes (LinkIndex): Index of provided links to Instagram pages and VK albums.
+            manifest (SpoolManifest, optional): Manifest of folders to collect files from.
+            Defaults to None, which means all folders in SPOOL_DIR.
+        """
+        self.routes = routes
+        self.videos = list()
+        self.images = list()
+
+        if manifest is None:
+            print('Fetching files!')
+            manifest = SpoolManifest()
+        self.manifest = manifest
+        self.get_files_to_upload()
+
+    def get_links(self, username: str, is_post: bool) -> VKRoute:
+        """Get VK group and album ids for image and video files for provided username and type of post.
+
+        Args:
+            username (str): Instagram username.
+            is_post (bool): True if need links to upload Instagram post, False if uploading stories.
+
+        Returns:
+            VKRoute: Tuple of ids to VK folders.
+        """
+        return self.routes.get(username, is_post)
+
+    @METRICS.stage('get_files_to_upload')
+    def get_files_to_upload(self) -> None:
+        """Getting tuples sorted by folder counter
+            (path, video_name, description, vk_video_group, vk_video_album) for videos
+            (path, description, vk_image_group, vk_image_album) for images.
+        """
+        for folder in self.manifest.sorted():
+            username = folder.username
+            if username not in self.routes:
+                print(f'{folder.name}: {username} is not in Links.csv, skipping')
+                continue
+            vk_image_group, vk_image_album, vk_video_group, vk_video_album = self.get_links(
+                username, folder.is_post)
+
+            for item in folder.media:
+                path = self.manifest.path(folder.name, item)
+                date = item[2:10].replace('-', '')
+                if item.endswith('.mp4'):
+                    addition = f' Instagram @{username}' if folder.is_post else ' Instagram stories'
+                    video_name = date+addition
+                    self.videos.append(
+                        (path, video_name, folder.description, vk_video_group, vk_video_album))
+                else:
+                    self.images.append(
+                        (path, folder.description, vk_image_group, vk_image_album))
+
+
+class ImageOptimizer():
+    def __init__(self,
+                 quality: int = IMAGE_QUALITY,
+                 max_side: int = VK_MAX_IMAGE_SIDE,
+                 cache_dir: str = IMAGE_CACHE_DIR,
+                 num_workers: int = None) -> None:
+        """Class to downscale images to maximal resolution stored by VK and encode them again
+        with provided quality before uploading, so pixels which VK throws away are not uploaded.
+        Images are processed by pool of processes and results are cached by content hash.
+        Requires Pillow, without it images are uploaded as they are.
+
+        Args:
+            quality (int, optional): JPEG quality. Defaults to IMAGE_QUALITY.
+            max_side (int, optional): Maximal size of longest side in pixels. Defaults to VK_MAX_IMAGE_SIDE.
+            cache_dir (str, optional): Directory of cached results. Defaults to IMAGE_CACHE_DIR.
+            num_workers (int, optional): Number of processes. Defaults to None, which means number of CPU cores.
+        """
+        self.quality = quality
+        self.max_side = max_side
+        self.cache_dir = cache_dir
+        self.executor = None
+
+        if importlib.util.find_spec('PIL') is None:
+            print('Pillow is not installed, images are uploaded as they are')
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        self.prune_cache()
+        self.executor = ProcessPoolExecutor(max_workers=num_workers)
+
+    def __enter__(self) -> 'ImageOptimizer':
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def prune_cache(self) -> None:
+        """Deleting cached results which were not used for IMAGE_CACHE_TTL.
+        """
+        expired = time.time() - IMAGE_CACHE_TTL.total_seconds()
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+
+    def optimize(self, images: list, ledger: MirrorLedger = None) -> None:
+        """Replacing images with optimized ones and printing saved bytes and spent time.
+        Images which already have upload job in queue of ledger, for example waiting for next attempt,
+        were optimized before they were queued, so they are not encoded again and again losing quality.
+
+        Args:
+            images (list): List of tuples with path to image as first element.
+            ledger (MirrorLedger, optional): Ledger with queue of upload jobs. Defaults to None,
+            which means all images are optimized.
+        """
+        queued = ledger.pending_jobs('image') if ledger is not None else dict()
+        paths = [item[0] for item in images if item[0] not in queued]
+        if self.executor is None or not paths:
+            return
+        start = time.perf_counter()
+        sizes = list(self.executor.map(self.optimize_image, paths,
+                                       [self.quality]*len(paths),
+                                       [self.max_side]*len(paths),
+                                       [self.cache_dir]*len(paths)))
+        size_before = sum(size[0] for size in sizes)
+        size_after = sum(size[1] for size in sizes)
+        print(f'{len(paths)} images optimized in {time.perf_counter() - start:.1f}s, '
+              f'saved {(size_before - size_after)/1024/1024:.1f} of {size_before/1024/1024:.1f} MB')
+
+    @staticmethod
+    def optimize_image(path: str, quality: int, max_side: int, cache_dir: str) -> Tuple[int, int]:
+        """Replacing single image with downscaled and encoded again one if it is smaller.
+        Runs in pool process.
+
+        Args:
+            path (str): Path to image.
+            quality (int): JPEG quality.
+            max_side (int): Maximal size of longest side in pixels.
+            cache_dir (str): Directory of cached results.
+
+        Returns:
+            Tuple[int, int]: Size of image in bytes before and after optimizing,
+            the same size if image could not be optimized and was left as it is.
+        """
+        from PIL import Image
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        key = hashlib.sha256(data + f'{quality}:{max_side}'.encode()).hexdigest()
+        cached = os.path.join(cache_dir, key + '.jpg')
+
+        if os.path.exists(cached):
+            os.utime(cached)
+        else:
+            temp_path = f'{cached}.{os.getpid()}.tmp'
+            # Broken image is uploaded as it is, so its failure goes to queue of upload jobs instead of failing cycle
+            try:
+                with Image.open(io.BytesIO(data)) as image:
+                    image = image.convert('RGB')
+                    image.thumbnail((max_side, max_side))
+                    image.save(temp_path, 'JPEG', quality=quality, optimize=True)
+            except Exception as e:
+                print(f'{path} could not be optimized, uploading it as it is: {e!r}')
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return len(data), len(data)
+            os.replace(temp_path, cached)
+
+        optimized_size = os.path.getsize(cached)
+        if optimized_size >= len(data):
+            return len(data), len(data)
+        shutil.copyfile(cached, path)
+        return len(data), optimized_size
+
+
+class VKUploader:
+    def __init__(self,
+                 vk_session: vk_api.vk_api.VkApi,
+                 images: list,
+                 videos: list,
+                 manifest: SpoolManifest = None,
+                 num_workers: int = UPLOAD_WORKERS,
+                 ledger: MirrorLedger = None) -> None:
+        """Class to upload data to VK.
+
+        Args:
+            vk_session (vk_api.vk_api.VkApi): Session with access to provided VK group folders.
+            images (list): List of tuples with information about images to be uploaded in type
+            (path, description, vk_image_group, vk_image_album).
+            videos (list): List of tuples with information about videos to be uploaded in type
+            (path, video_name, description, vk_video_group, vk_video_album).
+            manifest (SpoolManifest, optional): Manifest of folders to be removed after uploading.
+            Defaults to None, which means all folders in SPOOL_DIR.
+            num_workers (int, optional): Number of VK albums uploaded at once. Defaults to UPLOAD_WORKERS.
+            ledger (MirrorLedger, optional): Ledger of already uploaded files. Defaults to None,
+            which means ledger stored in LEDGER_PATH.
+        """
+        import requests
+        import vk_api
+
+        self.vk_session = vk_session
+        self.num_workers = num_workers
+        self.ledger = ledger if ledger is not None else MirrorLedger()
+        self.manifest = manifest if manifest is not None else SpoolManifest()
+        self.upload = vk_api.VkUpload(self.vk_session)
+        # Workers share connections of single pool instead of opening new ones for every file
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=num_workers)
+        self.upload.http.mount('https://', adapter)
+        self.video_upload = ChunkedVideoUploader(
+            self.vk_session, self.upload.http)
+        # Failed attempts of queued jobs by path
+        self.attempts = dict()
+        # Files moved to dead-letter directory during this upload
+        self.buried = list()
+        self.images = self.schedule(self.skip_uploaded(images), 'image')
+        self.videos = self.schedule(self.skip_uploaded(videos), 'video')
+
+        try:
+            self.image_uploader()
+            self.video_uploader()
+        finally:
+            self.folder_remover()
+            self.report_jobs()
+            self.report_rate_limit()
+
+    def skip_uploaded(self, items: list) -> list:
+        """Removing files which were already uploaded to VK according to ledger,
+        for example if previous start failed before deleting them.
+
+        Args:
+            items (list): List of tuples with path to file as first element.
+
+        Returns:
+            list: Tuples of files which are not uploaded yet.
+        """
+        not_uploaded = list()
+        for item in items:
+            if self.ledger.is_uploaded(item[0]):
+                print(f'{item[0]} is already uploaded, skipping')
+                self.remove_file(item[0])
+            else:
+                not_uploaded.append(item)
+        return not_uploaded
+
+    def schedule(self, items: list, kind: str) -> list:
+        """Adding every file to durable queue of upload jobs and getting files which are due to be uploaded now.
+        Jobs queued by previous starts go first, jobs waiting for their next attempt are left for next starts.
+
+        Args:
+            items (list): List of tuples with path to file as first element.
+            kind (str): image or video.
+
+        Returns:
+            list: Tuples of files to be uploaded now in order of queue.
+        """
+        self.ledger.add_jobs([item[0] for item in items], kind)
+        jobs = self.ledger.pending_jobs(kind)
+        paths = {item[0] for item in items}
+        for path in jobs:
+            # Jobs of files removed from disk by hand can not be finished anymore
+            if path not in paths and not os.path.exists(path):
+                self.ledger.finish_job(path)
+
+        now = time.time()
+        due = list()
+        for item in items:
+            order, attempts, next_attempt = jobs[item[0]]
+            if next_attempt > now:
+                print(f'{item[0]} failed {attempts} times, next attempt '
+                      f'after {datetime.fromtimestamp(next_attempt):%Y-%m-%d %H:%M}')
+                continue
+            self.attempts[item[0]] = attempts
+            due.append((order, item))
+        return [item for _, item in sorted(due, key=lambda x: x[0])]
+
+    def job_failed(self, paths: list, error: Exception) -> None:
+        """Storing failure of upload jobs, files of dead jobs are moved to folder with the same name
+        in DEAD_LETTER_DIR together with captions of their folder, so the folder can be moved back as it is.
+
+        Args:
+            paths (list): Paths to files which failed to upload.
+            error (Exception): Error of upload.
+        """
+        print(f'{paths} Vk upload failed: {error}')
+        METRICS.count('vk_upload_failures')
+        for path in paths:
+            if not self.ledger.fail_job(path, repr(error)):
+                continue
+            dead_path = os.path.join(DEAD_LETTER_DIR, os.path.basename(
+                os.path.dirname(path)), os.path.basename(path))
+            os.makedirs(os.path.dirname(dead_path), exist_ok=True)
+            # Folder is deleted after its other files are uploaded, captions are needed to upload file again
+            with os.scandir(os.path.dirname(path)) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.txt'):
+                        shutil.copyfile(entry.path, os.path.join(os.path.dirname(dead_path), entry.name))
+            os.replace(path, dead_path)
+            self.ledger.bury_job(path, dead_path)
+            self.manifest.discard(path)
+            self.buried.append(dead_path)
+            print(f'{path} failed {JOB_MAX_ATTEMPTS} times, moved to {dead_path}')
+
+    def report_jobs(self) -> None:
+        """Printing number of files moved to dead-letter directory during this upload.
+        Dead jobs which files were moved back or deleted by hand are removed from queue.
+        """
+        for path, _ in self.ledger.dead_jobs():
+            if not os.path.exists(path):
+                self.ledger.finish_job(path)
+        if self.buried:
+            print(f'{len(self.buried)} files failed to upload {JOB_MAX_ATTEMPTS} times and are kept in {DEAD_LETTER_DIR}, '
+                  f'move their folders back to {SPOOL_DIR} to try again')
+
+    @METRICS.stage('image_uploader')
+    def image_uploader(self) -> None:
+        """Image uploader to VK. Images going in a row to the same album with the same description
+        are uploaded by batches of up to VK_PHOTOS_PER_UPLOAD files, different albums are uploaded at once.
+        Images which failed before are uploaded alone, so single broken file does not fail other files again.
+        Deletes files after correct uploading.
+        """
+        albums = dict()
+        for path, description, vk_image_group, vk_image_album in self.images:
+            batches = albums.setdefault((vk_image_group, vk_image_album), list())
+            if (batches and batches[-1][1] == description and len(batches[-1][0]) < VK_PHOTOS_PER_UPLOAD
+                    and not self.attempts.get(path) and not self.attempts.get(batches[-1][0][-1])):
+                batches[-1][0].append(path)
+            else:
+                batches.append(([path], description))
+
+        uploads = AsyncWorker(albums.items(), lambda album: self.album_uploader(*album),
+                              self.num_workers)
+        if uploads.errors:
+            raise uploads.errors[0]
+        failed = sum(upload.result for upload in uploads.results)
+        if failed:
+            print(f'{failed} image batches failed, their files are kept for next start')
+
+    def album_uploader(self, album: Tuple[str, str], batches: list) -> int:
+        """Uploading batches of images to single VK album one after another to keep their order.
+
+        Args:
+            album (Tuple[str, str]): VK group and album ids.
+            batches (list): List of tuples (paths, description) to be uploaded.
+
+        Returns:
+            int: Number of failed batches.
+        """
+        failed = 0
+        for paths, description in batches:
+            try:
+                self.batch_uploader(paths, description, *album)
+            # Any error of single batch must not stop uploading of other batches
+            except Exception as e:
+                self.job_failed([path for path in paths if os.path.exists(path)], e)
+                failed += 1
+        return failed
+
+    def batch_uploader(self, paths: list, description: str, vk_image_group: str, vk_image_album: str) -> None:
+        """Uploading several images to VK album with single request. Deletes files after correct uploading.
+
+        Args:
+            paths (list): List of str paths to images.
+            description (str): Description of images.
+            vk_image_group (str): VK group id.
+            vk_image_album (str): VK album id.
+        """
+        album = f'{vk_image_group}_{vk_image_album}'
+        hashes = dict()
+        for path in paths:
+            content_hash = self.content_hash(path)
+            phash = self.perceptual_hash(path)
+            # Only exact copies are skipped, as files are deleted after that
+            vk_id = self.ledger.find_content(album, content_hash)
+            if vk_id is None:
+                hashes[path] = (content_hash, phash)
+                similar = self.ledger.find_similar(album, phash)
+                if similar is not None:
+                    print(f'{path} looks like https://vk.com/{similar}, uploading it anyway')
+                continue
+            print(f'{path} is already uploaded to https://vk.com/{vk_id}, skipping')
+            self.ledger.add_upload(path, vk_id)
+            self.remove_file(path)
+        paths = list(hashes)
+        if not paths:
+            return
+
+        cap = None
+        if description is not None:
+            cap = description.replace('@', '@ ')
+
+        size = sum(os.path.getsize(path) for path in paths)
+        with METRICS.request('vk_photo_upload'):
+            photos = self.upload.photo(
+                photos=paths,
+                caption=cap,
+                group_id=vk_image_group,
+                album_id=vk_image_album
+            )
+        METRICS.count('vk_upload_bytes', size)
+
+        for path, photo in zip(paths, photos):
+            vk_photo_url = 'https://vk.com/photo{}_{}'.format(
+                photo['owner_id'], photo['id'])
+            profile_info = os.path.basename(os.path.dirname(path))
+            print('\n'+f'{profile_info} Vk upload done to {vk_photo_url}'+'\n')
+
+            vk_id = 'photo{}_{}'.format(photo['owner_id'], photo['id'])
+            self.ledger.add_upload(path, vk_id)
+            self.ledger.add_content(album, *hashes[path], vk_id)
+            self.remove_file(path)
+
+    @METRICS.stage('video_uploader')
+    def video_uploader(self) -> None:
+        """Video uploader to VK. Videos of different albums are uploaded at once,
+        videos of the same album one after another to keep their order.
+        Deletes files after correct uploading.
+        """
+        albums = dict()
+        for item in self.videos:
+            albums.setdefault((item[3], item[4]), list()).append(item)
+
+        uploads = AsyncWorker(albums.values(), self.video_album_uploader,
+                              VIDEO_UPLOAD_WORKERS)
+        if uploads.errors:
+            raise uploads.errors[0]
+        failed = sum(upload.result for upload in uploads.results)
+        if failed:
+            print(f'{failed} videos failed, their uploads continue on next start')
+
+    def video_album_uploader(self, videos: list) -> int:
+        """Uploading videos of single VK album one after another.
+
+        Args:
+            videos (list): List of tuples (path, video_name, description, vk_video_group, vk_video_album).
+
+        Returns:
+            int: Number of failed videos.
+        """
+        failed = 0
+        for item in videos:
+            try:
+                self.video_item_uploader(item)
+            # Any error of single video must not stop uploading of other videos
+            except Exception as e:
+                self.job_failed([item[0]], e)
+                failed += 1
+        return failed
+
+    def video_item_uploader(self, item: tuple) -> None:
+        """Uploading single video to VK album unless the same video is already there. Deletes file after correct uploading.
+
+        Args:
+            item (tuple): Tuple (path, video_name, description, vk_video_group, vk_video_album).
+        """
+        album = f'{item[3]}_{item[4]}'
+        content_hash = self.content_hash(item[0])
+        vk_id = self.ledger.find_content(album, content_hash)
+        if vk_id is None:
+            vk_id = self.reuse_video(content_hash, item[3], item[4])
+        if vk_id is not None:
+            print(f'{item[0]} is already uploaded to https://vk.com/{vk_id}, skipping')
+            self.ledger.add_upload(item[0], vk_id)
+            self.ledger.add_content(album, content_hash, None, vk_id)
+            self.remove_file(item[0])
+            return
+
+        desc = None
+        if item[2] is not None:
+            desc = item[2].replace('@', '@ ')
+
+        video = self.video_upload.upload(
+            video_file=item[0],
+            name=item[1],
+            description=desc,
+            group_id=item[3],
+            album_id=item[4]
+        )
+
+        vk_video_url = 'https://vk.com/video{}_{}'.format(
+            video['owner_id'], video['video_id'])
+        profile_info = os.path.basename(os.path.dirname(item[0]))
+        print('\n'+f'{profile_info} Vk upload done to {vk_video_url}'+'\n')
+
+        vk_id = 'video{}_{}'.format(video['owner_id'], video['video_id'])
+        self.ledger.add_upload(item[0], vk_id)
+        self.ledger.add_content(album, content_hash, None, vk_id)
+        self.remove_file(item[0])
+
+    def reuse_video(self, content_hash: str, vk_video_group: str, vk_video_album: str) -> str:
+        """Adding video with the same content which was uploaded to another album to provided album
+        instead of uploading it again.
+
+        Args:
+            content_hash (str): Hash of video content.
+            vk_video_group (str): VK group id.
+            vk_video_album (str): VK album id.
+
+        Returns:
+            str: VK id of added video, None if there is no such video or it could not be added.
+        """
+        import vk_api
+
+        vk_id = self.ledger.find_content_anywhere(content_hash)
+        if vk_id is None:
+            return None
+        owner_id, video_id = vk_id[len('video'):].split('_')
+        try:
+            self.vk_session.method('video.addToAlbum', {
+                'target_id': -int(vk_video_group),
+                'album_id': vk_video_album,
+                'owner_id': owner_id,
+                'video_id': video_id,
+            })
+        except vk_api.exceptions.VkApiError as e:
+            print(f'{vk_id} could not be added to album, uploading again: {e}')
+            return None
+        return vk_id
+
+    @staticmethod
+    def content_hash(path: str) -> str:
+        """Get fast hash of file content.
+
+        Args:
+            path (str): Path to file.
+
+        Returns:
+            str: Hex digest of BLAKE2b hash.
+        """
+        content_hash = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024*1024), b''):
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    @staticmethod
+    def perceptual_hash(path: str) -> str:
+        """Get difference hash of image which stays the same after resizing and encoding image again.
+        Requires Pillow.
+
+        Args:
+            path (str): Path to image.
+
+        Returns:
+            str: 64 bit hash in hex form, None if Pillow is not installed or image could not be read.
+        """
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+        try:
+            with Image.open(path) as image:
+                pixels = list(image.convert('L').resize((9, 8)).getdata())
+        except OSError:
+            return None
+        bits = 0
+        for row in range(8):
+            for column in range(8):
+                bits = bits << 1 | (pixels[row*9 + column] > pixels[row*9 + column + 1])
+        return f'{bits:016x}'
+
+    def report_rate_limit(self) -> None:
+        """Printing current VK API rate and amount of throttling errors if session is limited,
+        and number of requests used by batched calls.
+        """
+        rate_limit = getattr(self.vk_session, 'rate_limit', None)
+        if rate_limit is not None:
+            print(f'VK API rate {rate_limit.effective_rate:.2f}/s, '
+                  f'throttled {rate_limit.throttle_events} times')
+        batcher = getattr(self.vk_session, 'batcher', None)
+        if batcher is not None:
+            print(f'{batcher.calls} VK API calls sent with {batcher.requests} requests')
+
+    def remove_file(self, path: str) -> None:
+        """Deleting uploaded file and removing it from manifest and queue of upload jobs.
+
+        Args:
+            path (str): Path to file.
+        """
+        os.remove(path)
+        self.manifest.discard(path)
+        self.ledger.finish_job(path)
+
+    def folder_remover(self) -> None:
+        """Delets folders of manifest in which there are no files of type mp4 and jpg left.
+        """
+        for folder in self.manifest.sorted():
+            if not folder.media:
+                shutil.rmtree(self.manifest.path(folder.name))
+
+
+class Pipeline:
+    def __init__(self,
+                 data: DataPreparer,
+                 queue_size: int = PIPELINE_QUEUE_SIZE,
+                 optimizer: ImageOptimizer = None) -> None:
+        """Class to upload downloaded posts and stories to VK while downloading is still going.
+        Downloaded folders are put to bounded queue, so downloading waits for uploading
+        when there are too many folders waiting on disk.
+
+        Args:
+            data (DataPreparer): Prepared sessions and links.
+            queue_size (int, optional): Maximum number of folders waiting for upload. Defaults to PIPELINE_QUEUE_SIZE.
+            optimizer (ImageOptimizer, optional): Optimizer of images before uploading. Defaults to None,
+            which means images are uploaded as they are.
+        """
+        self.data = data
+        self.folders = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.error = None
+        self.optimizer = optimizer
+
+        downloader = threading.Thread(target=self.download, daemon=True)
+        downloader.start()
+        try:
+            self.upload()
+        finally:
+            # If uploading failed, downloader is stopped and unblocked instead of waiting for full queue forever
+            self.stopping.set()
+            while downloader.is_alive():
+                try:
+                    self.folders.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            downloader.join()
+        if self.error is not None:
+            raise self.error
+
+    def download(self) -> None:
+        """Putting folders left from previous start and new downloaded folders to queue.
+        None is put to queue when downloading is finished.
+        """
+        try:
+            # The same manifest is passed to downloader, as spool is not scanned again
+            # while uploading is already removing left folders
+            manifest = SpoolManifest()
+            for folder in manifest.sorted():
+                self.put(folder.name)
+            InstagramDownloader(self.data.inst_session, self.data.routes,
+                                self.data.cursors, self.data.date_now,
+                                on_folder=self.put, ledger=self.data.ledger,
+                                profiles=self.data.profiles, budget=self.data.budget,
+                                manifest=manifest)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.folders.put(None)
+
+    def put(self, folder: str) -> None:
+        """Putting folder to queue, waiting while queue is full.
+
+        Args:
+            folder (str): Name of downloaded folder.
+
+        Raises:
+            RuntimeError: If uploading is stopped, so downloading is aborted. Folder stays on disk for next start.
+        """
+        if self.stopping.is_set():
+            raise RuntimeError('Uploading stopped, downloading aborted')
+        self.folders.put(folder)
+
+    def upload(self) -> None:
+        """Uploading folders from queue to VK until downloading is finished.
+        """
+        while True:
+            folder = self.folders.get()
+            if folder is None:
+                break
+            fetched = DataCollector(
+                self.data.routes, SpoolManifest([folder]))
+            if self.optimizer is not None:
+                self.optimizer.optimize(fetched.images, self.data.ledger)
+            VKUploader(self.data.vk_session, fetched.images, fetched.videos,
+                       fetched.manifest, ledger=self.data.ledger)
+
+
+class Daemon:
+    def __init__(self,
+                 data: DataPreparer,
+                 interval: timedelta = DAEMON_INTERVAL,
+                 pipeline: bool = False,
+                 zero_disk: bool = False,
+                 optimize_images: bool = False) -> None:
+        """Class to run sync cycles on schedule, keeping VK and Instagram sessions of provided data warm.
+        Links file is reloaded only if it was changed. SIGTERM or SIGINT stops daemon after current cycle,
+        second signal stops it at once.
+
+        Args:
+            data (DataPreparer): Prepared sessions and links.
+            interval (timedelta, optional): Time between starts of cycles. Defaults to DAEMON_INTERVAL.
+            pipeline (bool, optional): True to run cycles in pipeline mode. Defaults to False.
+            zero_disk (bool, optional): True to run cycles in zero disk mode. Defaults to False.
+            optimize_images (bool, optional): True to optimize images before uploading. Defaults to False.
+        """
+        self.data = data
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            self.data.reload_links()
+            self.data.date_now = datetime.utcnow()
+            self.data.cursors.new_cycle(self.data.date_now)
+            self.data.profiles.new_run()
+            checker = self.data.check_links_in_background()
+            try:
+                run_cycle(self.data, pipeline, zero_disk, optimize_images)
+            except Exception as e:
+                # Single failed cycle should not stop daemon, next cycle starts from stored progress
+                print(f'Cycle failed: {e!r}')
+            checker.join()
+            self.data.checkpoint()
+            print(f'Next cycle in {interval}')
+            self.stopping.wait(max(0.0, interval.total_seconds() -
+                                   (time.monotonic() - started)))
+        print('Daemon stopped!')
+
+    def stop(self, signum: int, frame) -> None:
+        """Signal handler which asks daemon to stop after current cycle.
+
+        Args:
+            signum (int): Received signal.
+            frame: Current stack frame.
+        """
+        if self.stopping.is_set():
+            raise SystemExit(1)
+        print('Stopping after current cycle, send signal again to stop at once')
+        self.stopping.set()
+
+
+def upload_folders(data: DataPreparer, manifest: SpoolManifest, optimizer: ImageOptimizer = None) -> None:
+    """Uploading downloaded folders of manifest to VK.
+
+    Args:
+        data (DataPreparer): Prepared sessions and links.
+        manifest (SpoolManifest): Manifest of folders to be uploaded.
+        optimizer (ImageOptimizer, optional): Optimizer of images before uploading. Defaults to None,
+        which means images are uploaded as they are.
+    """
+    fetched = DataCollector(data.routes, manifest)
+    if optimizer is not None:
+        optimizer.optimize(fetched.images, data.ledger)
+    VKUploader(data.vk_session, fetched.images, fetched.videos,
+               fetched.manifest, ledger=data.ledger)
+
+
+def run_cycle(data: DataPreparer,
+              pipeline: bool = False,
+              zero_disk: bool = False,
+              optimize_images: bool = False) -> None:
+    """Downloading new posts and stories and uploading them to VK.
+
+    Args:
+        data (DataPreparer): Prepared sessions and links.
+        pipeline (bool, optional): True to upload folders while downloading is still going. Defaults to False.
+        zero_disk (bool, optional): True to upload media to VK without storing it on disk,
+        folders left from previous starts are uploaded after that. Defaults to False.
+        optimize_images (bool, optional): True to optimize images stored on disk before uploading. Defaults to False.
+    """
+    # Single optimizer is shared by all uploads of cycle, so its process pool is started once
+    with ImageOptimizer() if optimize_images else nullcontext() as optimizer:
+        if pipeline and not zero_disk:
+            # Stages of pipeline overlap each other, so its whole wall time is measured too
+            with METRICS.stage('pipeline'):
+                Pipeline(data, optimizer=optimizer)
+        else:
+            manifest = SpoolManifest()
+
+            def upload_stories(folders: list) -> None:
+                # Stories are uploaded by chunks instead of being kept on disk until all of them are downloaded.
+                # Posts and folders left from previous starts have lower counters and go first with them,
+                # so order is kept in albums shared by posts and stories
+                uploaded = [folder.name for folder in manifest.sorted()]
+                upload_folders(data, manifest, optimizer)
+                manifest.forget(uploaded)
+
+            streamer = None
+            if zero_disk:
+                streamer = StreamingMirror(data.inst_session, data.vk_session,
+                                           data.routes, data.ledger)
+            InstagramDownloader(data.inst_session, data.routes,
+                                data.cursors, data.date_now, ledger=data.ledger,
+                                profiles=data.profiles, budget=data.budget, streamer=streamer,
+                                manifest=manifest, on_stories_chunk=None if zero_disk else upload_stories)
+            upload_folders(data, manifest, optimizer)
+    print('Uploading done!')
+    METRICS.write()
+    METRICS.reset()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Mirror new Instagram posts and stories to VK albums.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='upload folders to VK while downloading is still going')
+    parser.add_argument('--zero-disk', action='store_true',
+                        help='upload media from Instagram to VK without storing it on disk')
+    parser.add_argument('--optimize-images', action='store_true',
+                        help='downscale and compress images before uploading them to VK, requires Pillow')
+    parser.add_argument('--prometheus', metavar='PATH',
+                        help='also write metrics of every cycle to file in Prometheus text format')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and start sync cycles on schedule')
+    parser.add_argument('--interval', type=float, default=DAEMON_INTERVAL.total_seconds()/60,
+                        help='minutes between starts of sync cycles in daemon mode')
+    args = parser.parse_args()
+    METRICS.prometheus_path = args.prometheus
+
+    data = DataPreparer()
+    if args.daemon:
+        Daemon(data, timedelta(minutes=args.interval),
+               args.pipeline, args.zero_disk, args.optimize_images)
+    else:
+        checker = data.check_links_in_background()
+        run_cycle(data, args.pipeline, args.zero_disk, args.optimize_images)
+        checker.join()
+        data.checkpoint()
+        if sys.stdin.isatty():
+            input()
@@ -0,0 +1,66 @@
+"""Tests of AsyncWorker results, errors and timeouts."""
+import asyncio
+import time
+
+import instagram_to_vk as mirror
+
+
+def test_results_keep_order_of_data_and_errors_do_not_stop_other_items():
+    def double(item):
+        if item == 2:
+            raise ValueError(item)
+        return item*2
+
+    worker = mirror.AsyncWorker(range(5), double, 2)
+    assert [result.result for result in worker.results] == [0, 2, None, 6, 8]
+    assert [type(error) for error in worker.errors] == [ValueError]
+
+
+def test_timeout_does_not_wait_for_plain_function():
+    start = time.perf_counter()
+    worker = mirror.AsyncWorker([1, 2], lambda item: time.sleep(1), 2, timeout=0.1)
+    assert time.perf_counter() - start < 0.5
+    assert all(isinstance(error, asyncio.TimeoutError) for error in worker.errors)
+    assert len(worker.errors) == 2
+
+
+def test_stop_on_cancels_items_which_are_not_started():
+    def fail(item):
+        raise ConnectionError(item)
+
+    worker = mirror.AsyncWorker(range(3), fail, 1, stop_on=(ConnectionError,))
+    assert [type(error) for error in worker.errors] == [ConnectionError,
+                                                        asyncio.CancelledError, asyncio.CancelledError]
+
+
+def test_host_limits_cap_items_of_host_without_holding_up_other_hosts():
+    running = {'slow': 0, 'fast': 0}
+    peaks = {'slow': 0, 'fast': 0}
+    finished = list()
+
+    async def visit(item):
+        host, number = item
+        running[host] += 1
+        peaks[host] = max(peaks[host], running[host])
+        await asyncio.sleep(0.05 if host == 'slow' else 0.01)
+        running[host] -= 1
+        finished.append(item)
+
+    items = [('slow', number) for number in range(4)] + [('fast', number) for number in range(4)]
+    mirror.AsyncWorker(items, visit, 3, host=lambda item: item[0], host_limits={'slow': 1})
+    assert peaks == {'slow': 1, 'fast': 2}
+    # Items of fast host are not queued behind items of slow host
+    assert [host for host, _ in finished[:4]] == ['fast']*4
+
+
+def test_stop_on_cancels_only_items_of_the_same_host():
+    def visit(item):
+        if item[0] == 'throttled':
+            raise ConnectionError(item)
+        return item
+
+    items = [('throttled', 1), ('throttled', 2), ('other', 1), ('other', 2)]
+    worker = mirror.AsyncWorker(items, visit, 2, host=lambda item: item[0], host_limits={'throttled': 1},
+                                stop_on=(ConnectionError,))
+    assert [type(result.error) for result in worker.results] == [
+        ConnectionError, asyncio.CancelledError, type(None), type(None)]
@@ -0,0 +1,44 @@
+"""Tests of ImageOptimizer with broken images and images waiting for next upload attempt."""
+import os
+
+import pytest
+
+import instagram_to_vk as mirror
+
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def make_image(path: str) -> int:
+    Image.effect_noise((512, 512), 64).convert('RGB').save(path, 'JPEG', quality=100)
+    return os.path.getsize(path)
+
+
+def test_broken_image_is_left_as_it_is(workdir):
+    with open('broken.jpg', 'wb') as file:
+        file.write(b'not an image')
+    size = make_image('image.jpg')
+
+    with mirror.ImageOptimizer(num_workers=1) as optimizer:
+        optimizer.optimize([('broken.jpg',), ('image.jpg',)])
+
+    with open('broken.jpg', 'rb') as file:
+        assert file.read() == b'not an image'
+    assert os.path.getsize('image.jpg') < size
+
+
+def test_queued_image_is_not_encoded_again(workdir):
+    size = make_image('image.jpg')
+    ledger = mirror.MirrorLedger()
+    ledger.add_jobs(['image.jpg'], 'image')
+
+    with mirror.ImageOptimizer(num_workers=1) as optimizer:
+        optimizer.optimize([('image.jpg',)], ledger)
+
+    assert os.path.getsize('image.jpg') == size
+    ledger.connection.close()
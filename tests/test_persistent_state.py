@@ -0,0 +1,175 @@
+"""Tests of state kept across starts: ledger of mirrored media, download cursors
+and durable queue of upload jobs. Every test runs in its own working directory.
+"""
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import pytest
+
+import instagram_to_vk as mirror
+
+FOLDER = '1_posts：page'
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def ledger(workdir):
+    ledger = mirror.MirrorLedger()
+    yield ledger
+    ledger.connection.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Unix time seen by mirror, moved forward by tests instead of waiting."""
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(mirror.time, 'time', lambda: now[0])
+    return now
+
+
+def make_files(folder: str, files: list) -> list:
+    os.makedirs(os.path.join(mirror.SPOOL_DIR, folder), exist_ok=True)
+    paths = list()
+    for file in files:
+        path = os.path.join(mirror.SPOOL_DIR, folder, file)
+        with open(path, 'w', encoding='UTF-8') as stream:
+            stream.write(file)
+        paths.append(path)
+    return paths
+
+
+def make_uploader(ledger: mirror.MirrorLedger) -> mirror.VKUploader:
+    # VKUploader uploads everything in __init__, so only state of job queue is set up
+    uploader = mirror.VKUploader.__new__(mirror.VKUploader)
+    uploader.ledger = ledger
+    uploader.manifest = mirror.SpoolManifest()
+    uploader.attempts = dict()
+    uploader.buried = list()
+    return uploader
+
+
+def test_ledger_keeps_downloads_and_uploads_across_starts(ledger):
+    path, = make_files(FOLDER, ['a.jpg'])
+    ledger.add_download('shortcode', 'posts', FOLDER)
+    ledger.add_upload(path, 'photo-1_2')
+    ledger.connection.close()
+
+    reopened = mirror.MirrorLedger()
+    assert reopened.is_downloaded('shortcode')
+    assert reopened.is_uploaded(path)
+    assert not reopened.is_uploaded(os.path.join(mirror.SPOOL_DIR, FOLDER, 'b.jpg'))
+    assert not reopened.is_downloaded('other')
+    reopened.connection.close()
+
+
+def test_cursors_start_from_last_start_and_never_move_back(workdir):
+    last_start = datetime(2024, 1, 1)
+    now = datetime(2024, 1, 10)
+    cursors = mirror.ProfileCursors(last_start, now)
+    assert cursors.get('page', 'posts') == last_start
+
+    cursors.advance('page', 'posts', datetime(2024, 1, 5))
+    cursors.advance('page', 'posts', datetime(2024, 1, 3))
+    assert cursors.get('page', 'posts') == datetime(2024, 1, 5)
+
+    reopened = mirror.ProfileCursors(last_start, now, lookback=timedelta(days=2))
+    assert reopened.get('page', 'posts') == datetime(2024, 1, 5)
+    assert reopened.get('page', 'stories') == now - timedelta(days=2)
+    assert reopened.get('new_page', 'posts') == now - timedelta(days=2)
+
+
+def test_new_cycle_moves_start_of_new_pages(workdir):
+    last_start = datetime(2024, 1, 1)
+    cursors = mirror.ProfileCursors(last_start, datetime(2024, 1, 10), lookback=timedelta(days=2))
+    # Without file pages keep starting from last start of module
+    cursors.new_cycle(datetime(2024, 1, 11))
+    assert cursors.get('new_page', 'posts') == last_start
+
+    cursors.advance('page', 'posts', datetime(2024, 1, 9))
+    cursors.new_cycle(datetime(2024, 1, 20))
+    assert cursors.get('new_page', 'posts') == datetime(2024, 1, 18)
+    assert cursors.get('page', 'posts') == datetime(2024, 1, 9)
+
+
+def test_failed_job_waits_for_doubled_delay(ledger, clock, monkeypatch):
+    monkeypatch.setattr(mirror, 'JOB_MAX_ATTEMPTS', 10)
+    path, = make_files(FOLDER, ['a.jpg'])
+    ledger.add_jobs([path], 'image')
+
+    delays = list()
+    for _ in range(8):
+        assert not ledger.fail_job(path, 'error')
+        delays.append(ledger.pending_jobs('image')[path][2] - clock[0])
+    expected = [min(mirror.JOB_RETRY_BASE*2**number, mirror.JOB_RETRY_MAX).total_seconds()
+                for number in range(8)]
+    assert delays == expected
+    assert delays[-1] == mirror.JOB_RETRY_MAX.total_seconds()
+
+
+def test_schedule_leaves_job_until_its_next_attempt(ledger, clock):
+    path, = make_files(FOLDER, ['a.jpg'])
+    items = [(path, None, '1', '2')]
+    uploader = make_uploader(ledger)
+    assert uploader.schedule(items, 'image') == items
+    ledger.fail_job(path, 'error')
+
+    assert uploader.schedule(items, 'image') == []
+    clock[0] += mirror.JOB_RETRY_BASE.total_seconds() + 1
+    assert uploader.schedule(items, 'image') == items
+    assert uploader.attempts[path] == 1
+
+
+def test_jobs_drain_in_queue_order_across_starts(ledger, clock, monkeypatch):
+    monkeypatch.setattr(mirror, 'JOB_RETRY_BASE', timedelta(0))
+    first, second = make_files(FOLDER, ['a.jpg', 'b.jpg'])
+    uploader = make_uploader(ledger)
+    uploader.schedule([(first, None, '1', '2'), (second, None, '1', '2')], 'image')
+    ledger.fail_job(first, 'error')
+    ledger.finish_job(second)
+    ledger.connection.close()
+
+    # Newly downloaded file goes after file left in queue by previous start
+    newer, = make_files('2_posts：page', ['c.jpg'])
+    reopened = mirror.MirrorLedger()
+    uploader = make_uploader(reopened)
+    due = uploader.schedule([(newer, None, '1', '2'), (first, None, '1', '2')], 'image')
+    assert [item[0] for item in due] == [first, newer]
+    reopened.connection.close()
+
+
+def test_dead_job_is_moved_with_captions_and_can_be_moved_back(ledger, monkeypatch):
+    monkeypatch.setattr(mirror, 'JOB_MAX_ATTEMPTS', 2)
+    path, caption = make_files(FOLDER, ['a.jpg', 'a.txt'])
+    uploader = make_uploader(ledger)
+    uploader.schedule([(path, None, '1', '2')], 'image')
+
+    uploader.job_failed([path], OSError('first'))
+    assert os.path.exists(path)
+    uploader.job_failed([path], OSError('second'))
+
+    dead_folder = os.path.join(mirror.DEAD_LETTER_DIR, FOLDER)
+    dead_path = os.path.join(dead_folder, 'a.jpg')
+    assert not os.path.exists(path)
+    assert os.path.exists(dead_path)
+    assert os.path.exists(os.path.join(dead_folder, 'a.txt'))
+    assert ledger.dead_jobs() == [(dead_path, repr(OSError('second')))]
+    assert ledger.pending_jobs('image') == dict()
+    assert uploader.buried == [dead_path]
+
+    # Dead job is kept while its file is in dead-letter directory
+    make_uploader(ledger).report_jobs()
+    assert len(ledger.dead_jobs()) == 1
+
+    shutil.rmtree(os.path.join(mirror.SPOOL_DIR, FOLDER))
+    shutil.move(dead_folder, os.path.join(mirror.SPOOL_DIR, FOLDER))
+    make_uploader(ledger).report_jobs()
+    assert ledger.dead_jobs() == []
+    uploader = make_uploader(ledger)
+    assert uploader.schedule([(path, None, '1', '2')], 'image') == [(path, None, '1', '2')]
+    assert uploader.attempts[path] == 0